@@ -0,0 +1,440 @@
+"""asyncio interface for CodeBug.
+
+AsyncSerialChannelDevice speaks the same protocol as SerialChannelDevice
+but never blocks the event loop. Replies are read from the serial port's
+file descriptor with `loop.add_reader` and requests from every coroutine
+go through one queue, so many coroutines can share a CodeBug and one
+event loop can drive many CodeBugs. For example:
+
+    import asyncio
+    from codebug_tether.aio import AsyncCodeBug
+
+    async def blink(codebug):
+        for i in range(10):
+            await codebug.set_pixel(2, 2, i % 2)
+            await asyncio.sleep(0.5)
+
+    async def main():
+        async with AsyncCodeBug() as codebug:
+            await asyncio.gather(blink(codebug), codebug.get_input('A'))
+
+    asyncio.run(main())
+
+"""
+import asyncio
+import struct
+import serial
+from .serial_channel_device import (ACK_BYTE,
+                                    AckError,
+                                    get_packet,
+                                    set_packet,
+                                    get_bulk_packet,
+                                    set_bulk_packet,
+                                    and_packet,
+                                    or_packet,
+                                    get_buffer_packet,
+                                    set_buffer_packet)
+from .core import (CodeBug,
+                   i2c_packets,
+                   spi_control,
+                   DEFAULT_SERIAL_PORT,
+                   UART_DEFAULT_BAUD,
+                   UART_TX_BUFFER_INDEX,
+                   UART_RX_BUFFER_INDEX,
+                   UART_TX_GO_BUSY_MASK,
+                   UART_RX_GO_BUSY_MASK,
+                   EXTENSION_CONF_IO,
+                   EXTENSION_CONF_SPI,
+                   EXTENSION_CONF_I2C,
+                   EXTENSION_CONF_UART,
+                   CHANNEL_INDEX_OUTPUT,
+                   CHANNEL_INDEX_LEG_INPUT,
+                   CHANNEL_INDEX_BUTTON_INPUT,
+                   CHANNEL_INDEX_ANALOGUE_CONF,
+                   CHANNEL_INDEX_ANALOGUE_INPUT,
+                   CHANNEL_INDEX_IO_DIRECTION_LEGS,
+                   CHANNEL_INDEX_IO_DIRECTION_EXT,
+                   CHANNEL_INDEX_EXT_CONF,
+                   CHANNEL_INDEX_SPI_LENGTH,
+                   CHANNEL_INDEX_UART_RX_OFFSET,
+                   CHANNEL_INDEX_UART_TX_OFFSET,
+                   CHANNEL_INDEX_UART_CONTROL)
+
+
+# seconds to wait for a response, same as the CodeBug serial port timeout
+RESPONSE_TIMEOUT = 2
+
+
+class AsyncSerialChannelDevice():
+    """A SerialChannelDevice which is driven by an asyncio event loop.
+
+    Every method which talks to the device is a coroutine. Requests
+    are queued and a single worker task sends everything which is
+    waiting in the queue in one write, then hands each request its
+    response. Requests made with `transactions` are sent back to back
+    so that other coroutines can't get in between them.
+
+    The serial port must be non-blocking (pyserial `timeout=0`) and have
+    a file descriptor (`fileno`).
+    """
+
+    def __init__(self, serial_port, timeout=RESPONSE_TIMEOUT):
+        self.serial_port = serial_port
+        self.timeout = timeout
+        # these belong to the event loop, created on first use
+        self._requests = None
+        self._worker = None
+        self._rx_ready = None
+        self._rx_buffer = bytearray()
+        self._rx_error = None
+        # the requests the worker is sending
+        self._active = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stops the worker task and closes the serial port. Requests
+        which haven't been answered fail with SerialException.
+        """
+        if self._worker is not None:
+            self._stop(serial.SerialException('Port was closed.'))
+        self.serial_port.close()
+
+    async def get(self, channel_index):
+        """Returns a channel value as bytes."""
+        return await self.transaction(get_packet(channel_index), 1)
+
+    async def set(self, channel_index, value):
+        """Sets a channel value."""
+        await self.transaction(set_packet(channel_index, value))
+
+    async def get_bulk(self, channel_index, length):
+        """Returns `length` adjacent channel values as bytes."""
+        return await self.transaction(get_bulk_packet(channel_index, length),
+                                      length)
+
+    async def set_bulk(self, channel_index, value_bytes):
+        """Sets adjacent channel values."""
+        await self.transaction(set_bulk_packet(channel_index, value_bytes))
+
+    async def and_mask(self, channel_index, mask):
+        """ANDs a channel value with mask."""
+        await self.transaction(and_packet(channel_index, mask))
+
+    async def or_mask(self, channel_index, mask):
+        """ORs a channel value with mask."""
+        await self.transaction(or_packet(channel_index, mask))
+
+    async def set_bit(self, channel_index, bit_index, state):
+        """Sets a bit in a channel to state."""
+        if state:
+            await self.or_mask(channel_index, 1 << bit_index)
+        else:
+            await self.and_mask(channel_index, 0xff ^ (1 << bit_index))
+
+    async def get_bit(self, channel_index, bit_index):
+        """Returns a bit from a channel."""
+        value = struct.unpack('B', await self.get(channel_index))[0]
+        return (value >> bit_index) & 0x1
+
+    async def get_buffer(self, buffer_index, length, offset=0):
+        """Returns `length` bytes from a buffer, starting at offset."""
+        return await self.transaction(
+            get_buffer_packet(buffer_index, length, offset), length)
+
+    async def set_buffer(self, buffer_index, value_bytes, offset=0):
+        """Writes value_bytes into a buffer, starting at offset."""
+        await self.transaction(
+            set_buffer_packet(buffer_index, value_bytes, offset))
+
+    async def transaction(self, tx_bytes, rx_length=0):
+        """Sends a packet and waits for a ACK response. Returns the
+        `rx_length` data bytes which the device sends after the ACK.
+        """
+        return (await self.transactions(((tx_bytes, rx_length),)))[0]
+
+    async def transactions(self, packets):
+        """Sends several packets back to back and returns a list
+        containing the response data for each packet.
+
+        Args:
+            packets: Sequence of (tx_bytes, rx_length) tuples.
+
+        """
+        loop = asyncio.get_running_loop()
+        if self._worker is None:
+            self._start(loop)
+        elif self._worker.get_loop() is not loop:
+            # used from a new event loop, for example a second
+            # asyncio.run, so move the worker to it
+            self._stop(RuntimeError('The event loop changed.'))
+            self._start(loop)
+        elif self._worker.done():
+            # the worker should never stop, but don't hang if it has
+            self._worker = loop.create_task(self._serve())
+        future = loop.create_future()
+        self._requests.put_nowait((packets, future))
+        return await future
+
+    def _start(self, loop):
+        self._requests = asyncio.Queue()
+        self._rx_ready = asyncio.Event()
+        self._rx_buffer.clear()
+        self._rx_error = None
+        loop.add_reader(self.serial_port.fileno(), self._on_readable)
+        self._worker = loop.create_task(self._serve())
+
+    def _stop(self, error):
+        """Stops the worker and fails the requests it hasn't answered
+        with error.
+        """
+        loop = self._worker.get_loop()
+        requests, self._active = self._active, []
+        while not self._requests.empty():
+            requests.append(self._requests.get_nowait())
+        # a closed loop has already cancelled everything
+        if not loop.is_closed():
+            loop.remove_reader(self.serial_port.fileno())
+            self._worker.cancel()
+            self._fail(requests, error)
+        self._worker = None
+
+    def _on_readable(self):
+        try:
+            self._rx_buffer += self.serial_port.read(
+                max(1, self.serial_port.in_waiting))
+        except Exception as error:
+            # handed to the worker, which is waiting for the response
+            self._rx_error = error
+        self._rx_ready.set()
+
+    async def _read(self, length):
+        while len(self._rx_buffer) < length:
+            if self._rx_error is not None:
+                error, self._rx_error = self._rx_error, None
+                raise error
+            self._rx_ready.clear()
+            await self._rx_ready.wait()
+        rx_bytes = bytes(self._rx_buffer[:length])
+        del self._rx_buffer[:length]
+        return rx_bytes
+
+    async def _read_responses(self, packets):
+        responses = []
+        for packet_number, (tx_bytes, rx_length) in enumerate(packets):
+            # CodeBug will always return an ACK byte
+            if await self._read(1) != ACK_BYTE:
+                raise AckError(
+                    'Packet {} of {} ({}) was not acknowledged.'.format(
+                        packet_number + 1, len(packets), tx_bytes.hex()))
+            responses.append(await self._read(rx_length))
+        return responses
+
+    async def _serve(self):
+        """Sends queued requests and hands out their responses."""
+        while True:
+            requests = [await self._requests.get()]
+            while not self._requests.empty():
+                requests.append(self._requests.get_nowait())
+            self._active = requests
+            try:
+                await self._send(requests)
+            finally:
+                self._active = []
+
+    async def _send(self, requests):
+        try:
+            self.serial_port.write(b''.join(tx_bytes
+                                            for packets, _ in requests
+                                            for tx_bytes, _ in packets))
+        except Exception as error:
+            self._fail(requests, error)
+            return
+
+        for i, (packets, future) in enumerate(requests):
+            try:
+                responses = await asyncio.wait_for(
+                    self._read_responses(packets), self.timeout)
+            except Exception as error:
+                if isinstance(error, asyncio.TimeoutError):
+                    error = AckError('Timed out waiting for a response.')
+                # we've lost track of the responses, give up on the rest
+                # of this write
+                self._rx_buffer.clear()
+                self._fail(requests[i:], error)
+                return
+            if not future.done():
+                future.set_result(responses)
+
+    @staticmethod
+    def _fail(requests, error):
+        for _, future in requests:
+            if not future.done():
+                future.set_exception(error)
+
+
+class AsyncCodeBug(AsyncSerialChannelDevice):
+    """Manipulates CodeBug over a USB serial connection from asyncio.
+
+    Methods work like their `codebug_tether.CodeBug` equivalents but
+    must be awaited.
+    """
+
+    def __init__(self, serial_port=DEFAULT_SERIAL_PORT,
+                 timeout=RESPONSE_TIMEOUT):
+        if isinstance(serial_port, str):
+            serial_port = serial.Serial(serial_port, timeout=0)
+        super().__init__(serial_port, timeout=timeout)
+
+    async def get_input(self, input_index):
+        """Returns the state of an input. You can use 'A' and 'B' to
+        access buttons A and B.
+        """
+        input_index = CodeBug._int_input_index(input_index)
+        if input_index > 7:
+            return await self.get_bit(CHANNEL_INDEX_BUTTON_INPUT,
+                                      input_index - 8)
+        else:
+            return await self.get_bit(CHANNEL_INDEX_LEG_INPUT, input_index)
+
+    async def read_analogue(self, leg_index):
+        """Reads the analogue value of the leg at leg_index."""
+        responses = await self.transactions(
+            ((set_packet(CHANNEL_INDEX_ANALOGUE_CONF, leg_index), 0),
+             (get_packet(CHANNEL_INDEX_ANALOGUE_INPUT), 1)))
+        return struct.unpack('B', responses[1])[0]
+
+    async def set_output(self, output_index, state):
+        """Sets the output index to state."""
+        await self.set_bit(CHANNEL_INDEX_OUTPUT, output_index, state)
+
+    async def get_output(self, output_index):
+        """Returns the state of the output at index."""
+        return await self.get_bit(CHANNEL_INDEX_OUTPUT, output_index)
+
+    async def set_leg_io(self, leg_index, direction):
+        """Sets the I/O direction of the leg at index."""
+        if leg_index < 4:
+            channel_index = CHANNEL_INDEX_IO_DIRECTION_LEGS
+            clear_mask = 0xff ^ (0b11 << leg_index * 2)
+            direction_mask = (0b11 & direction) << leg_index * 2
+        else:
+            ext_index = leg_index - 4
+            channel_index = CHANNEL_INDEX_IO_DIRECTION_EXT
+            clear_mask = 0b11 << ext_index * 2
+            direction_mask = (0b11 & direction) << ext_index * 2
+        await self.transactions(
+            ((and_packet(channel_index, clear_mask), 0),
+             (or_packet(channel_index, direction_mask), 0)))
+
+    async def clear(self):
+        """Clears the pixels on CodeBug."""
+        await self.set_bulk(0, bytes([0]*5))
+
+    async def fill(self):
+        """Sets all pixels on."""
+        await self.set_bulk(0, bytes([0x1f]*5))
+
+    async def set_row(self, row, val):
+        """Sets a row of pixels on CodeBug."""
+        await self.set(row, val)
+
+    async def get_row(self, row):
+        """Returns a row of pixels on CodeBug."""
+        return struct.unpack('B', await self.get(min(row, 5)))[0]
+
+    async def set_pixel(self, x, y, state):
+        """Sets a pixel on CodeBug."""
+        await self.set_bit(min(y, 5), 4 - x, state)
+
+    async def get_pixel(self, x, y):
+        """Returns the state of a pixel on CodeBug."""
+        return await self.get_bit(min(y, 5), 4 - x)
+
+    async def config_extension_io(self):
+        await self.set(CHANNEL_INDEX_EXT_CONF, EXTENSION_CONF_IO)
+
+    async def config_extension_spi(self):
+        await self.set(CHANNEL_INDEX_EXT_CONF, EXTENSION_CONF_SPI)
+
+    async def config_extension_i2c(self):
+        await self.set(CHANNEL_INDEX_EXT_CONF, EXTENSION_CONF_I2C)
+
+    async def config_extension_uart(self):
+        await self.set(CHANNEL_INDEX_EXT_CONF, EXTENSION_CONF_UART)
+
+    async def spi_transaction(self,
+                              data,
+                              cs_idle_high=1,
+                              input_sample_middle=1,
+                              spi_mode=0):
+        """Run an SPI transaction using the extensions pins. Returns the
+        data which was received.
+        """
+        control = spi_control(cs_idle_high, input_sample_middle, spi_mode)
+        data = bytes(data)
+        responses = await self.transactions(
+            ((set_buffer_packet(0, data), 0),
+             (set_bulk_packet(CHANNEL_INDEX_SPI_LENGTH,
+                              (len(data), control)), 0),
+             (get_buffer_packet(0, len(data)), len(data))))
+        return responses[2]
+
+    async def i2c_transaction(self, *messages, add_stop_last_message=True):
+        """Run an I2C transaction using the extensions pins. All of the
+        messages are sent back to back. Returns the data which was read
+        as a tuple.
+        """
+        packets = i2c_packets(messages, add_stop_last_message)
+        responses = await self.transactions(packets)
+        return tuple(value for response in responses for value in response)
+
+    async def uart_set_baud(self, baud):
+        await self.set(CHANNEL_INDEX_UART_CONTROL,
+                       CodeBug._get_uart_control_baud(baud))
+
+    async def uart_tx(self, data_bytes, baud=UART_DEFAULT_BAUD):
+        """Transmits data bytes over UART."""
+        control = (CodeBug._get_uart_control_baud(baud) |
+                   UART_TX_GO_BUSY_MASK)
+        await self.transactions(
+            ((set_buffer_packet(UART_TX_BUFFER_INDEX, data_bytes), 0),
+             (set_bulk_packet(CHANNEL_INDEX_UART_TX_OFFSET,
+                              (0, len(data_bytes), control)), 0)))
+
+    async def uart_tx_start(self, length, offset=0, baud=UART_DEFAULT_BAUD):
+        """Transmits 'length' data bytes from UART buffer starting at
+        'offset' over UART.
+        """
+        control = (CodeBug._get_uart_control_baud(baud) |
+                   UART_TX_GO_BUSY_MASK)
+        await self.set_bulk(CHANNEL_INDEX_UART_TX_OFFSET,
+                            bytes((offset, length, control)))
+
+    async def uart_tx_set_buffer(self, data_bytes, offset=0):
+        """Add data_bytes to the UART buffer at offset."""
+        await self.set_buffer(UART_TX_BUFFER_INDEX, data_bytes, offset)
+
+    async def uart_rx_start(self, length, baud=UART_DEFAULT_BAUD, offset=0):
+        """Begins receiving on the UART. RX will stop when length data is
+        reached.
+        """
+        control = (CodeBug._get_uart_control_baud(baud) |
+                   UART_RX_GO_BUSY_MASK)
+        await self.transactions(
+            ((set_bulk_packet(CHANNEL_INDEX_UART_RX_OFFSET,
+                              (offset, length)), 0),
+             (set_packet(CHANNEL_INDEX_UART_CONTROL, control), 0)))
+
+    async def uart_rx_is_ready(self):
+        """Returns True if the UART has finished receiving data."""
+        uart_control = (await self.get(CHANNEL_INDEX_UART_CONTROL))[0]
+        return uart_control & UART_RX_GO_BUSY_MASK == 0
+
+    async def uart_rx_get_buffer(self, length, offset=0):
+        """Returns data bytes from UART buffer."""
+        return await self.get_buffer(UART_RX_BUFFER_INDEX, length, offset)
@@ -0,0 +1,285 @@
+"""Measures what each CodeBug API costs on the wire.
+
+Run against the emulator (default) or a real CodeBug:
+
+    $ python3 -m codebug_tether.benchmark
+    $ python3 -m codebug_tether.benchmark --port /dev/ttyACM0 -o new.json
+
+For every API it reports the packets sent, bytes written and read, ACK
+waits (times the host blocked for a response) and latency percentiles
+per call. Results are written as JSON so they can be tracked across
+releases. To compare two versions, save the results with one version
+installed and pass them as the baseline when running the other:
+
+    $ python3 -m codebug_tether.benchmark -o old.json
+    $ # install the other version
+    $ python3 -m codebug_tether.benchmark --baseline old.json
+
+`--colourtail` also measures the colour tail refresh rate for a range of
+strip lengths, sending every pixel each frame:
+
+    $ python3 -m codebug_tether.benchmark --baudrate 115200 --colourtail \
+          colourtail_update
+
+"""
+import sys
+import json
+import time
+import argparse
+from .version import __version__
+from .serial_channel_device import packet_length
+
+
+DEFAULT_REPEAT = 50
+COLOURTAIL_LENGTHS = (10, 25, 50, 75, 85)
+# values compared against the baseline
+COMPARED = ('packets', 'ack_waits', 'bytes_written', 'bytes_read')
+
+
+class CountingSerialPort():
+    """Wraps a serial port and counts the traffic going through it."""
+
+    def __init__(self, serial_port):
+        self.serial_port = serial_port
+        self._partial = bytearray()
+        self.reset()
+
+    def __getattr__(self, name):
+        return getattr(self.serial_port, name)
+
+    def reset(self):
+        self.packets = 0
+        self.writes = 0
+        self.ack_waits = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def counters(self):
+        return {'packets': self.packets,
+                'writes': self.writes,
+                'ack_waits': self.ack_waits,
+                'bytes_written': self.bytes_written,
+                'bytes_read': self.bytes_read}
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes_written += len(data)
+        self._partial += data
+        while True:
+            length = packet_length(self._partial)
+            if length is None or len(self._partial) < length:
+                break
+            del self._partial[:length]
+            self.packets += 1
+        return self.serial_port.write(data)
+
+    def read(self, size=1):
+        self.ack_waits += 1
+        data = self.serial_port.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value at fraction (0-1) through sorted_values."""
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1,
+                int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def get_benchmarks(codebug):
+    """Returns a dict of API name: function(i) which calls the API
+    once. The functions are given the iteration number.
+    """
+    # imported here so that the module can be loaded on its own
+    from .i2c import (reading, writing)
+    from .sprites import StringSprite
+    from .colourtail import CodeBugColourTail
+
+    sprite = StringSprite('A')
+    scroll = StringSprite('Hi')
+    colourtail = CodeBugColourTail(codebug)
+    spi_data = bytes(range(16))
+    uart_data = bytes(range(16))
+
+    return {
+        'set_pixel': lambda i: codebug.set_pixel(i % 5, (i // 5) % 5, i % 2),
+        'set_col': lambda i: codebug.set_col(i % 5, 0x15),
+        'draw_sprite': lambda i: codebug.draw_sprite(i % 5, 0, sprite),
+        'scroll_sprite': lambda i: codebug.scroll_sprite(scroll,
+                                                         interval=0),
+        'set_leg_io': lambda i: codebug.set_leg_io(i % 8, i % 2),
+        'servo_set': lambda i: codebug.servo_set(0, 1000 + i),
+        'i2c_transaction': lambda i: codebug.i2c_transaction(
+            writing(0x1c, (0x12,)), reading(0x1c, 6)),
+        'spi_transaction': lambda i: codebug.spi_transaction(spi_data),
+        'spi_write': lambda i: codebug.spi_write(spi_data),
+        'spi_read': lambda i: codebug.spi_read(len(spi_data)),
+        'uart_tx': lambda i: codebug.uart_tx(uart_data),
+        'colourtail_update': lambda i: (
+            colourtail.set_pixel(i % colourtail.length, i & 0xff, 0, 0),
+            colourtail.update()),
+    }
+
+
+def run(codebug, counter, repeat=DEFAULT_REPEAT, names=None):
+    """Runs the benchmarks and returns the results as a dict."""
+    benchmarks = get_benchmarks(codebug)
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if names and name not in names:
+            continue
+        latencies = []
+        counter.reset()
+        for i in range(repeat):
+            start = time.perf_counter()
+            benchmark(i)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        result = {key: value / repeat
+                  for key, value in counter.counters().items()}
+        result['latency_ms'] = {
+            'mean': 1000 * sum(latencies) / repeat,
+            'p50': 1000 * percentile(latencies, 0.5),
+            'p90': 1000 * percentile(latencies, 0.9),
+            'p99': 1000 * percentile(latencies, 0.99),
+            'max': 1000 * latencies[-1]}
+        results[name] = result
+    return results
+
+
+def colourtail_sweep(codebug, counter, lengths=COLOURTAIL_LENGTHS,
+                     repeat=DEFAULT_REPEAT):
+    """Times full colour tail updates for each strip length and returns
+    the achieved frames per second and traffic per frame as a dict.
+    """
+    from .colourtail import CodeBugColourTail
+
+    results = {}
+    for length in lengths:
+        colourtail = CodeBugColourTail(codebug, length)
+        counter.reset()
+        start = time.perf_counter()
+        for i in range(repeat):
+            colourtail.fill(i & 0xff, 0, 0)
+            colourtail.update()
+        elapsed = time.perf_counter() - start
+        result = {key: value / repeat
+                  for key, value in counter.counters().items()}
+        result['fps'] = repeat / elapsed if elapsed else 0
+        results[str(length)] = result
+    return results
+
+
+def compare(results, baseline):
+    """Returns the change from baseline to results for each API as a
+    dict of ratios (new / old).
+    """
+    changes = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old = baseline[name]
+        change = {}
+        for key in COMPARED:
+            if key in old and old[key]:
+                change[key] = result[key] / old[key]
+        old_p50 = old.get('latency_ms', {}).get('p50')
+        if old_p50:
+            change['latency_p50'] = result['latency_ms']['p50'] / old_p50
+        changes[name] = change
+    return changes
+
+
+def print_results(results, changes=None, file=sys.stderr):
+    header = '{:<18} {:>8} {:>9} {:>8} {:>8} {:>9} {:>9}'
+    row = '{:<18} {:>8.1f} {:>9.1f} {:>8.1f} {:>8.1f} {:>9.3f} {:>9.3f}'
+    print(header.format('api', 'packets', 'ack_waits', 'written', 'read',
+                        'p50 ms', 'p99 ms'), file=file)
+    for name, result in results.items():
+        print(row.format(name,
+                         result['packets'],
+                         result['ack_waits'],
+                         result['bytes_written'],
+                         result['bytes_read'],
+                         result['latency_ms']['p50'],
+                         result['latency_ms']['p99']), file=file)
+        if changes and name in changes:
+            print('{:<18} {}'.format('', ', '.join(
+                '{} x{:.2f}'.format(key, value)
+                for key, value in changes[name].items())), file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the CodeBug tether APIs.')
+    parser.add_argument('--port',
+                        help='serial port of a real CodeBug (default: use '
+                             'the emulator)')
+    parser.add_argument('--baudrate', type=int, default=None,
+                        help='simulated baud rate for the emulator')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='simulated seconds per write for the emulator')
+    parser.add_argument('-n', '--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='calls per API (default: %(default)s)')
+    parser.add_argument('-o', '--output',
+                        help='write JSON results to this file (default: '
+                             'stdout)')
+    parser.add_argument('--baseline',
+                        help='JSON results from an earlier run to compare '
+                             'against')
+    parser.add_argument('--colourtail', action='store_true',
+                        help='also measure colour tail refresh rates for '
+                             'strip lengths from {} to {}'.format(
+                                 COLOURTAIL_LENGTHS[0],
+                                 COLOURTAIL_LENGTHS[-1]))
+    parser.add_argument('apis', nargs='*', help='only run these APIs')
+    args = parser.parse_args(argv)
+
+    from .core import CodeBug
+    if args.port:
+        import serial
+        serial_port = serial.Serial(args.port, timeout=2)
+    else:
+        from .emulator import (CodeBugEmulator, FakeSerialPort)
+        emulator = CodeBugEmulator(uart_timing=False)
+        serial_port = FakeSerialPort(emulator,
+                                     baudrate=args.baudrate,
+                                     latency=args.latency)
+    counter = CountingSerialPort(serial_port)
+    codebug = CodeBug(counter)
+
+    results = run(codebug, counter, args.repeat, args.apis)
+    output = {'version': __version__,
+              'port': args.port or 'emulator',
+              'repeat': args.repeat,
+              'results': results}
+    if args.colourtail:
+        sweep = colourtail_sweep(codebug, counter, repeat=args.repeat)
+        output['colourtail'] = sweep
+        for length, result in sweep.items():
+            print('colourtail {:>3} pixels: {:>8.1f} fps, {:>6.1f} bytes '
+                  'written'.format(length, result['fps'],
+                                   result['bytes_written']), file=sys.stderr)
+
+    changes = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        changes = compare(results, baseline['results'])
+        output['baseline'] = {'version': baseline.get('version'),
+                              'changes': changes}
+
+    print_results(results, changes)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
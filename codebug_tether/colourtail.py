@@ -1,6 +1,11 @@
 """Colour tails interface for CodeBug."""
+import numbers
+import functools
+import itertools
 from collections import namedtuple
-from codebug_tether.core import (CHANNEL_INDEX_COLOURTAIL_LENGTH,
+from codebug_tether.core import (BUFFER_SIZE,
+                                 MAX_BUFFER_LENGTH,
+                                 CHANNEL_INDEX_COLOURTAIL_LENGTH,
                                  CHANNEL_INDEX_COLOURTAIL_CONTROL)
 
 
@@ -13,11 +18,24 @@ COLOURTAIL_CONTROL_INIT_NOT_UPDATE = 0x02
 COLOURTAIL_CONTROL_LEG0_NOT_CS = 0x04
 
 PIXEL_BUFFER_SIZE = 50
+# the strip is sent from buffer 0 with one SET BUFFER, so it has to fit
+# in the buffer and in a one byte length
+MAX_PIXELS = min(BUFFER_SIZE, MAX_BUFFER_LENGTH) // 3
 
 
 RGBPixel = namedtuple('RGBPixel', ['red', 'green', 'blue'])
 
 
+@functools.lru_cache(maxsize=32)
+def colour_lut(gamma=1.0, brightness=1.0):
+    """Returns a 256 byte table for `bytes.translate` which gamma corrects
+    and then scales (0-1) colour values. Values scaled past 255 are
+    clamped to 255.
+    """
+    return bytes(min(255, int(round(255 * brightness * (i / 255) ** gamma)))
+                 for i in range(256))
+
+
 class CodeBugColourTail():
     """CodeBugColourTail stores and sends RGB pixel values to a connected
     CodeBug Colour Tail (strip of WS2812s).
@@ -59,12 +77,45 @@ class CodeBugColourTail():
         colourtail.pixel_buffer[1] = RGBPixel(0, 0, 255)
         colourtail.update()  # turn on the LEDs
 
-    """
+    Pixels are kept in `grb` (a bytearray in the order they are sent:
+    green, red, blue) and `update` only uploads the ones which have
+    changed. Many pixels can be set at once with `set_pixels` and `fill`:
+
+        colourtail.fill(0, 0, 32)  # all dim blue
+        colourtail.set_pixels(10, bytes((255, 0, 0) * 5))  # 10-14 red
+        colourtail.update()
+
+    Strips longer than 50 pixels can be used by passing their length, up
+    to MAX_PIXELS (85, as many as fit in one SET BUFFER):
 
-    pixel_buffer = [RGBPixel(0, 0, 0)]*PIXEL_BUFFER_SIZE
+        colourtail = CodeBugColourTail(codebug, length=80)
 
-    def __init__(self, codebug):
+    Gamma correction and a brightness limit (to cap the current the
+    strip draws) can be applied to everything sent, either for all
+    colours or per (red, green, blue):
+
+        colourtail.set_correction(gamma=2.2, brightness=(0.5, 0.4, 0.4))
+
+    """
+
+    def __init__(self, codebug, length=PIXEL_BUFFER_SIZE):
+        if not 0 < length <= MAX_PIXELS:
+            raise ValueError(
+                'Colour tails can be 1 to {} pixels long.'.format(MAX_PIXELS))
         self.codebug = codebug
+        self.length = length
+        # pixels in the order they are sent: green, red, blue
+        self.grb = bytearray(3 * length)
+        self.pixel_buffer = PixelBuffer(self)
+        # bytes of grb which have changed since the last update
+        self._dirty_start = 0
+        self._dirty_end = len(self.grb)
+        # colour_luts in GRB order, None when there's no correction
+        self._luts = None
+        # codebug.buffer_writes[0] after our last upload, buffer 0 is
+        # shared with SPI, I2C and UART so if anything else has written
+        # to it the whole strip has to be sent again
+        self._uploaded = None
 
     def init(self, use_leg_0_not_cs=False):
         control = (COLOURTAIL_CONTROL_GO_BUSY |
@@ -73,18 +124,163 @@ class CodeBugColourTail():
             control |= COLOURTAIL_CONTROL_LEG0_NOT_CS
         self.codebug.set(CHANNEL_INDEX_COLOURTAIL_CONTROL, control)
 
+    def _changed(self, start, end):
+        """Marks pixels start to end (exclusive) as changed."""
+        self._dirty_start = min(self._dirty_start, 3 * start)
+        self._dirty_end = max(self._dirty_end, 3 * end)
+
+    def set_correction(self, gamma=1.0, brightness=1.0):
+        """Sets the gamma correction and brightness (0-1) applied to
+        the pixels when they are sent. Either can be one value for all
+        colours or a (red, green, blue) sequence.
+        """
+        if isinstance(gamma, numbers.Real):
+            gamma = (gamma,) * 3
+        if isinstance(brightness, numbers.Real):
+            brightness = (brightness,) * 3
+        # colour_lut is cached so its arguments must be hashable
+        gamma = tuple(gamma)
+        brightness = tuple(brightness)
+        red, green, blue = (colour_lut(g, b) for g, b in zip(gamma,
+                                                             brightness))
+        identity = colour_lut()
+        if red == green == blue == identity:
+            self._luts = None
+        else:
+            self._luts = (green, red, blue)
+        # what the strip is showing was corrected differently
+        self._changed(0, self.length)
+
+    def _corrected(self, grb, offset):
+        """Returns grb, which starts at byte offset, with the correction
+        applied.
+        """
+        if self._luts is None:
+            return bytes(grb)
+        if self._luts[0] == self._luts[1] == self._luts[2]:
+            return grb.translate(self._luts[0])
+        corrected = bytearray(grb)
+        for i in range(3):
+            lut = self._luts[(offset + i) % 3]
+            corrected[i::3] = grb[i::3].translate(lut)
+        return bytes(corrected)
+
+    def _index(self, index):
+        """Returns index (which can be negative) as a pixel number."""
+        if not -self.length <= index < self.length:
+            raise IndexError('pixel index out of range')
+        return index % self.length
+
     def get_pixel(self, index):
-        return self.pixel_buffer[index]
+        i = 3 * self._index(index)
+        green, red, blue = self.grb[i:i+3]
+        return RGBPixel(red=red, green=green, blue=blue)
 
     def set_pixel(self, index, red, green, blue):
-        self.pixel_buffer[index] = RGBPixel(red=red, green=green, blue=blue)
+        index = self._index(index)
+        i = 3 * index
+        self.grb[i:i+3] = bytes((green, red, blue))
+        self._changed(index, index + 1)
+
+    def set_pixels(self, start, rgb_bytes):
+        """Sets the pixels from start onwards from bytes of red, green,
+        blue values, for example bytes((255, 0, 0, 0, 255, 0)) sets pixel
+        start to red and the one after it to green.
+        """
+        count = len(rgb_bytes) // 3
+        start = self._index(start)
+        if start + count > self.length:
+            raise IndexError('{} pixels from {} is past the end of the '
+                             'colour tail.'.format(count, start))
+        if count == 0:
+            return
+        rgb_bytes = memoryview(bytes(rgb_bytes))[:3 * count]
+        i = 3 * start
+        end = i + 3 * count
+        self.grb[i:end:3] = rgb_bytes[1::3]
+        self.grb[i+1:end:3] = rgb_bytes[0::3]
+        self.grb[i+2:end:3] = rgb_bytes[2::3]
+        self._changed(start, start + count)
+
+    def fill(self, red, green, blue, start=0, end=None):
+        """Sets pixels start to end (default: all of them) to one
+        colour.
+        """
+        if end is None:
+            end = self.length
+        if not 0 <= start <= self.length or not 0 <= end <= self.length:
+            raise IndexError('pixel index out of range')
+        if end > start:
+            self.grb[3*start:3*end] = bytes((green, red, blue)) * (end - start)
+            self._changed(start, end)
+
+    def clear(self):
+        """Sets all of the pixels off."""
+        self.fill(0, 0, 0)
+
+    def play(self, effect, interval=1/60, repeat=1, skip=True):
+        """Plays an Effect (see `codebug_tether.effects`) at a steady rate,
+        repeat times (forever if repeat is None). Returns the
+        FrameScheduler which played it.
+        """
+        if effect.length != self.length:
+            raise ValueError('The effect is for {} pixels, the colour tail '
+                             'has {}.'.format(effect.length, self.length))
+        if repeat is None:
+            frames = itertools.chain.from_iterable(itertools.repeat(effect))
+        else:
+            frames = itertools.chain.from_iterable(
+                itertools.repeat(effect, repeat))
+
+        def render(frame):
+            self.grb[:] = frame
+            self._changed(0, self.length)
+            self.update()
+
+        return self.codebug.play(frames, interval, render, skip=skip)
 
     def update(self):
-        # WS2812 order is green, red, blue
-        codebug_buffer = [value
-                          for pixel in self.pixel_buffer[:PIXEL_BUFFER_SIZE]
-                          for value in (pixel.green, pixel.red, pixel.blue)]
+        """Sends the pixels to the colour tail. Only the pixels which
+        have changed since the last update are uploaded.
+        """
+        if self._uploaded != self.codebug.buffer_writes[0]:
+            start, end = 0, len(self.grb)
+        else:
+            start, end = self._dirty_start, self._dirty_end
         control = COLOURTAIL_CONTROL_GO_BUSY
-        self.codebug.set_buffer(0, bytes(codebug_buffer))
-        self.codebug.set_bulk(CHANNEL_INDEX_COLOURTAIL_LENGTH,
-                              bytes((len(self.pixel_buffer), control)))
+        with self.codebug.pipeline():
+            if end > start:
+                self.codebug.set_buffer(
+                    0, self._corrected(self.grb[start:end], start), start)
+            self.codebug.set_bulk(CHANNEL_INDEX_COLOURTAIL_LENGTH,
+                                  bytes((self.length, control)))
+        self._uploaded = self.codebug.buffer_writes[0]
+        self._dirty_start = len(self.grb)
+        self._dirty_end = 0
+
+
+class PixelBuffer():
+    """A list-like view of a CodeBugColourTail's pixels as RGBPixels."""
+
+    def __init__(self, colourtail):
+        self.colourtail = colourtail
+
+    def __len__(self):
+        return self.colourtail.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.colourtail.get_pixel(i)
+                    for i in range(*index.indices(len(self)))]
+        return self.colourtail.get_pixel(index)
+
+    def __setitem__(self, index, pixel):
+        if isinstance(index, slice):
+            for i, p in zip(range(*index.indices(len(self))), pixel):
+                self.colourtail.set_pixel(i, *p)
+        else:
+            self.colourtail.set_pixel(index, *pixel)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.colourtail.get_pixel(i)
@@ -1,9 +1,15 @@
 from __future__ import print_function
 import time
+import itertools
 import serial
 import struct
 from .i2c import *
-from .serial_channel_device import SerialChannelDevice
+from .serial_channel_device import (SerialChannelDevice,
+                                    set_bulk_packet,
+                                    get_buffer_packet,
+                                    set_buffer_packet)
+from .sprites import (Sprite, scroll_frames)
+from .scheduler import FrameScheduler
 from .platform import get_platform_serial_port
 
 
@@ -68,6 +74,17 @@ UART_BAUD_115200 = 7 << 2
 
 UART_DEFAULT_BAUD = 9600
 
+# bytes in each of CodeBug's buffers
+BUFFER_SIZE = 256
+# GET BUFFER and SET BUFFER offsets and lengths are one byte, as are the
+# SPI and UART length channels
+MAX_BUFFER_LENGTH = 0xff
+
+# SPI transfers are split into chunks of at most this many bytes and
+# this many chunks are sent per write
+SPI_CHUNK_SIZE = min(BUFFER_SIZE, MAX_BUFFER_LENGTH)
+SPI_CHUNKS_PER_WRITE = 8
+
 T2_PS_1_1 = 0
 T2_PS_1_4 = 1
 T2_PS_1_16 = 2
@@ -77,13 +94,121 @@ class InvalidBaud(Exception):
     pass
 
 
+def spi_control(cs_idle_high=1, input_sample_middle=1, spi_mode=0):
+    """Returns the SPI control channel value (with GO set) for the mode
+    settings, to pass to `spi_transfer`, `spi_write` and `spi_read` for
+    repeated transfers.
+    """
+    spi_mode = (spi_mode & 0x03) << 3
+    input_sample_middle = (input_sample_middle & 1) << 2
+    cs_idle_high = (cs_idle_high & 1) << 1
+    go = 0x01
+    return spi_mode | input_sample_middle | cs_idle_high | go
+
+
+def i2c_packets(messages, add_stop_last_message=True):
+    """Returns the (tx_bytes, rx_length) packets which send the I2C
+    messages. The messages are not changed.
+    """
+    packets = []
+    for i, message in enumerate(messages):
+        control = message.control
+        if add_stop_last_message and i == len(messages) - 1:
+            control |= I2C_CONTROL_STOP
+        # reads don't need anything in the buffer
+        if message.data:
+            packets.append((set_buffer_packet(0, bytes(message.data)), 0))
+        packets.append((set_bulk_packet(CHANNEL_INDEX_I2C_ADDR,
+                                        (message.address,
+                                         message.length,
+                                         control)), 0))
+        if control & I2C_CONTROL_READ_NOT_WRITE:
+            packets.append((get_buffer_packet(0, message.length),
+                            message.length))
+    return packets
+
+
+class I2CTransaction():
+    """An I2C transaction with its packets worked out up front. Calling
+    it sends all of the messages in one write and returns the data read
+    as a tuple, so it can be reused to poll a sensor cheaply:
+
+        >>> from codebug_tether.i2c import (reading, writing)
+        >>> codebug = CodeBug()
+        >>> codebug.config_extension_i2c()
+        >>> read_accel = codebug.compile_i2c_transaction(
+        ...     writing(0x1c, (0x01,)), reading(0x1c, 6))
+        >>> read_accel()
+        (65, 87, 47, 91, 43, 60)
+
+    """
+
+    def __init__(self, codebug, messages, add_stop_last_message=True):
+        self.codebug = codebug
+        self.packets = tuple(i2c_packets(messages, add_stop_last_message))
+        self._message_count = len(messages)
+
+    def __call__(self):
+        # every message uses buffer 0
+        self.codebug.buffer_writes[0] += self._message_count
+        responses = self.codebug.send_packets(self.packets)
+        return tuple(b''.join(responses))
+
+
 class CodeBug(SerialChannelDevice):
     """Manipulates CodeBug over a USB serial connection."""
 
-    def __init__(self, serial_port=DEFAULT_SERIAL_PORT):
-        super(CodeBug, self).__init__(serial.Serial(serial_port, timeout=2))
-
-    def _int_input_index(self, input_index):
+    coalescable_channels = {0: 0x1f,
+                            1: 0x1f,
+                            2: 0x1f,
+                            3: 0x1f,
+                            4: 0x1f,
+                            CHANNEL_INDEX_OUTPUT: 0xff,
+                            CHANNEL_INDEX_IO_DIRECTION_LEGS: 0xff,
+                            CHANNEL_INDEX_IO_DIRECTION_EXT: 0xff,
+                            CHANNEL_INDEX_PULLUPS: 0xff}
+
+    volatile_channels = frozenset((CHANNEL_INDEX_LEG_INPUT,
+                                   CHANNEL_INDEX_BUTTON_INPUT,
+                                   CHANNEL_INDEX_ANALOGUE_INPUT,
+                                   CHANNEL_INDEX_SPI_LENGTH,
+                                   CHANNEL_INDEX_SPI_CONTROL,
+                                   CHANNEL_INDEX_I2C_ADDR,
+                                   CHANNEL_INDEX_I2C_LENGTH,
+                                   CHANNEL_INDEX_I2C_CONTROL,
+                                   CHANNEL_INDEX_UART_RX_OFFSET,
+                                   CHANNEL_INDEX_UART_RX_LENGTH,
+                                   CHANNEL_INDEX_UART_TX_OFFSET,
+                                   CHANNEL_INDEX_UART_TX_LENGTH,
+                                   CHANNEL_INDEX_UART_CONTROL,
+                                   CHANNEL_INDEX_COLOURTAIL_LENGTH,
+                                   CHANNEL_INDEX_COLOURTAIL_CONTROL,
+                                   CHANNEL_INDEX_SERVO_PULSE_LENGTH,
+                                   CHANNEL_INDEX_SERVO_CONF))
+
+    def __init__(self, serial_port=DEFAULT_SERIAL_PORT, shadow=False,
+                 threadsafe=False):
+        """
+        :param serial_port: The name of the serial port CodeBug is
+            connected to, or an open serial port object (such as
+            `codebug_tether.emulator.FakeSerialPort`).
+        :param shadow: Keep a shadow copy of the display, output and
+            configuration channels so that reading them back (`get_row`,
+            `get_col`, `get_output`...) doesn't need a round trip.
+        :type shadow: bool
+        :param threadsafe: Allow CodeBug to be used from several threads
+            at once (for example, a `threading.Timer` and the main
+            thread).
+        :type threadsafe: bool
+        """
+        if isinstance(serial_port, str):
+            serial_port = serial.Serial(serial_port, timeout=2)
+        super(CodeBug, self).__init__(serial_port,
+                                      shadow=shadow,
+                                      threadsafe=threadsafe)
+
+    @staticmethod
+    def _int_input_index(input_index):
         """Returns an integer input index."""
         # 'A' is 8, 'B' is 9
         if isinstance(input_index, str):
@@ -333,35 +458,60 @@ class CodeBug(SerialChannelDevice):
             self.set_bulk(0, bytes(cb_rows))
         else:
             for i, row in enumerate(cb_rows):
-                self.or_mask(i, bytes(row))
+                self.or_mask(i, row)
 
     def scroll_sprite(self, sprite, interval=0.1, direction='L'):
         """Scrolls a sprite.
 
         Args:
-            sprite: The sprite to scroll.
+            sprite: The sprite to scroll, a LazyStringSprite, or a
+                ScrollSequence from `codebug_tether.sprites.compile_scroll`.
             interval: The time delay between each movement in seconds.
                 (optional)
             direction: The direction of the scroll ('L', 'R', 'U', 'D').
+                Ignored for ScrollSequences and LazyStringSprites.
+
+        """
+        self.play(scroll_frames(sprite, direction), interval)
+
+    def play(self, frames, interval=0.1, render=None, skip=True):
+        """Plays an animation at a steady rate and returns the
+        FrameScheduler which played it, which has the achieved `fps` and
+        counts of `late` and `skipped` frames.
+
+            >>> from codebug_tether.sprites import StringSprite
+            >>> codebug = CodeBug()
+            >>> sprites = [StringSprite(c) for c in '54321']
+            >>> codebug.play(sprites, interval=1).late
+            0
+
+        Args:
+            frames: Any iterable of frames (a ScrollSequence, a list of
+                Sprites, a generator, ...).
+            interval: Seconds between frames.
+            render: Function which draws a frame. By default frames are
+                drawn on the display and can be Sprites or the five
+                display row bytes. Everything render sends for a frame
+                goes in one write.
+            skip: Skip frames to catch up when falling behind.
 
         """
-        direction = direction.upper()[0]  # only take the first char
-        if direction == 'L':
-            for i in range(sprite.width+5):
-                self.draw_sprite(5-i, 0, sprite)
-                time.sleep(interval)
-        elif direction == 'D':
-            for i in range(sprite.height+5):
-                self.draw_sprite(0, 5-i, sprite)
-                time.sleep(interval)
-        elif direction == 'R':
-            for i in reversed(range(sprite.width+5)):
-                self.draw_sprite(5-i, 0, sprite)
-                time.sleep(interval)
-        elif direction == 'U':
-            for i in reversed(range(sprite.height+5)):
-                self.draw_sprite(0, 5-i, sprite)
-                time.sleep(interval)
+        if render is None:
+            render = self._render_frame
+        scheduler = FrameScheduler(interval, skip=skip)
+
+        def render_pipelined(frame):
+            with self.pipeline():
+                render(frame)
+
+        scheduler.play(frames, render_pipelined)
+        return scheduler
+
+    def _render_frame(self, frame):
+        if isinstance(frame, Sprite):
+            self.draw_sprite(0, 0, frame)
+        else:
+            self.set_bulk(0, bytes(frame))
 
     def config_extension_io(self):
         self.set(CHANNEL_INDEX_EXT_CONF, EXTENSION_CONF_IO)
@@ -398,18 +548,87 @@ class CodeBug(SerialChannelDevice):
             b'\xff\xff\xff'
 
         """
-        # control channel
-        spi_mode = (spi_mode & 0x03) << 3
-        input_sample_middle = (input_sample_middle & 1) << 2
-        cs_idle_high = (cs_idle_high & 1) << 1
-        go = 0x01
-        control = spi_mode | input_sample_middle | cs_idle_high | go
-        # put data into the buffer
-        self.set_buffer(0, bytes(list(data)))
-        # set the length and control channels in one go
-        self.set_bulk(CHANNEL_INDEX_SPI_LENGTH, bytes([len(data), control]))
-        # return data from buffer
-        return self.get_buffer(0, len(data))
+        return bytes(self.spi_transfer(data,
+                                       cs_idle_high=cs_idle_high,
+                                       input_sample_middle=input_sample_middle,
+                                       spi_mode=spi_mode))
+
+    def spi_transfer(self,
+                     data,
+                     write_only=False,
+                     cs_idle_high=1,
+                     input_sample_middle=1,
+                     spi_mode=0,
+                     chunk_size=SPI_CHUNK_SIZE,
+                     control=None):
+        """Run an SPI transfer of any length using the extension pins and
+        return the bytes read as a bytearray (None if write_only).
+
+        data can be bytes, a memoryview or any iterable of ints. It is
+        sent in chunks of chunk_size bytes (at most SPI_CHUNK_SIZE),
+        SPI_CHUNKS_PER_WRITE chunks (upload, transfer and read back) at a
+        time in one write. Chip select is released between chunks.
+        control (from `spi_control`) can be given instead of the mode
+        settings.
+
+            >>> codebug.config_extension_spi()
+            >>> rx = codebug.spi_transfer(bytes(1000))
+            >>> len(rx)
+            1000
+            >>> codebug.spi_transfer(frame_buffer, write_only=True)
+
+        """
+        if not 0 < chunk_size <= SPI_CHUNK_SIZE:
+            raise ValueError('chunk_size must be between 1 and {}.'.format(
+                SPI_CHUNK_SIZE))
+        if control is None:
+            control = spi_control(cs_idle_high, input_sample_middle, spi_mode)
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = memoryview(data).cast('B')
+            chunks = (data[i:i+chunk_size]
+                      for i in range(0, len(data), chunk_size))
+        else:
+            data = iter(data)
+            chunks = iter(lambda: bytes(itertools.islice(data, chunk_size)),
+                          b'')
+        rx_buffer = None if write_only else bytearray()
+        while True:
+            group = list(itertools.islice(chunks, SPI_CHUNKS_PER_WRITE))
+            if not group:
+                return rx_buffer
+            packets = []
+            for chunk in group:
+                packets.append((set_buffer_packet(0, chunk), 0))
+                # set the length and control channels in one go
+                packets.append((set_bulk_packet(CHANNEL_INDEX_SPI_LENGTH,
+                                                (len(chunk), control)), 0))
+                if not write_only:
+                    packets.append((get_buffer_packet(0, len(chunk)),
+                                    len(chunk)))
+            self.buffer_writes[0] += len(group)
+            responses = self.send_packets(packets)
+            if rx_buffer is not None:
+                for response in responses:
+                    rx_buffer += response
+
+    def spi_write(self, data, control=None):
+        """Sends data over SPI without reading anything back. control
+        is from `spi_control` (default mode if None).
+
+            >>> codebug.spi_write(bytes((0x01, 0x02, 0x03)))
+
+        """
+        self.spi_transfer(data, write_only=True, control=control)
+
+    def spi_read(self, length, fill=0xff, control=None):
+        """Reads length bytes over SPI, sending fill, and returns them as
+        a bytearray. control is from `spi_control` (default mode if None).
+
+            >>> codebug.spi_read(3)
+            bytearray(b'\xff\xff\xff')
+
+        """
+        return self.spi_transfer(bytes((fill,)) * length, control=control)
 
     def i2c_transaction(self,
                         *messages,
@@ -418,6 +637,10 @@ class CodeBug(SerialChannelDevice):
         """Run an I2C transaction using the extensions pins. Be sure to
         configure the extension pins first.
 
+        All of the messages are sent in one write (unless there is an
+        interval) and the messages aren't changed. Use
+        `compile_i2c_transaction` to send the same messages repeatedly.
+
         Args:
             messages: The I2C messages.
             add_stop_last_message: Adds stop flag to the last
@@ -460,46 +683,26 @@ class CodeBug(SerialChannelDevice):
                     writing(i2c_addr, 0x12, 0x34, 0x56, 0x78))
 
         """
-        # Can't use a tuple here because `+=` inside `send_msg` implicitly
-        # declares rx_buffer as a local variable (to send_msg).
+        if interval == 0:
+            return self.compile_i2c_transaction(
+                *messages, add_stop_last_message=add_stop_last_message)()
         rx_buffer = list()
-
-        def send_msg(msg):
-            """Sends a single i2c message."""
-            # print("send_msg")
-            # print("address", hex(msg.address))
-            # print("msg.data", msg.data)
-            # print("length", msg.length)
-            # print("control", bin(msg.control))
-            # print()
-            self.set_buffer(0, bytes(msg.data))
-            # set the i2c address, length and control all in one go
-            self.set_bulk(CHANNEL_INDEX_I2C_ADDR,
-                          bytes([msg.address, msg.length, msg.control]))
-            # if reading, add data to rx_buffer
-            if msg.control & I2C_CONTROL_READ_NOT_WRITE:
-                values = struct.unpack('B'*msg.length,
-                                       self.get_buffer(0, msg.length))
-                rx_buffer.extend(values)
+        for i, message in enumerate(messages):
+            transaction = I2CTransaction(
+                self, (message,),
+                add_stop_last_message and i == len(messages) - 1)
+            rx_buffer.extend(transaction())
             time.sleep(interval)
-
-        if add_stop_last_message:
-            # send all messages except for the last one
-            for message in messages[:-1]:
-                send_msg(message)
-
-            # add stop control flag to the last message
-            messages[-1].control |= I2C_CONTROL_STOP
-            send_msg(messages[-1])
-
-        else:
-            # send all messages
-            for message in messages:
-                send_msg(message)
-
         return tuple(rx_buffer)
 
-    def _get_uart_control_baud(self, baud):
+    def compile_i2c_transaction(self, *messages, add_stop_last_message=True):
+        """Returns an I2CTransaction which sends messages in one round
+        trip each time it is called. See `i2c_transaction`.
+        """
+        return I2CTransaction(self, messages, add_stop_last_message)
+
+    @staticmethod
+    def _get_uart_control_baud(baud):
         """Returns UART control value for given baud rate. Will raise
         InvalidBaud exception if baud is invalid.
         """
@@ -513,7 +716,8 @@ class CodeBug(SerialChannelDevice):
                         115200: 7 << 2}
         if baud not in baud_control:
             raise InvalidBaud('{} is not a valid baud rate (valid baud '
-                'rates: {}).'.format(baud, tuple(baud_control.keys())))
+                              'rates: {}).'.format(baud,
+                                                   tuple(baud_control.keys())))
         else:
             return baud_control[baud]
 
@@ -0,0 +1,150 @@
+"""Host-side framebuffer for CodeBug's 5x5 display."""
+from codebug_tether.sprites import scroll_frames
+from codebug_tether.scheduler import FrameScheduler
+
+
+NUM_ROWS = 5
+ROW_MASK = 0x1f
+
+
+def _packet_size(num_rows):
+    """Returns the bytes needed to send num_rows rows, with a SET for one
+    row and a SET BULK for more.
+    """
+    return 2 if num_rows == 1 else 2 + num_rows
+
+
+class Display():
+    """Holds CodeBug's display rows on the host and only sends the rows
+    which have changed when `flush` is called. Drawing methods work like
+    the CodeBug ones but don't send anything. For example:
+
+        from codebug_tether import CodeBug
+        from codebug_tether.display import Display
+
+        codebug = CodeBug()
+        display = Display(codebug)
+        display.set_pixel(0, 0, 1)
+        display.set_pixel(4, 4, 1)
+        display.flush()  # one SET BULK for rows 0-4
+        display.flush()  # nothing has changed, nothing is sent
+
+    The display assumes that only it writes to the display rows. Call
+    `invalidate` if something else has so that the next flush sends
+    everything.
+    """
+
+    def __init__(self, codebug):
+        self.codebug = codebug
+        self.rows = bytearray(NUM_ROWS)
+        # what the device is showing, None if we don't know
+        self._sent_rows = None
+
+    def invalidate(self):
+        """Forgets what the device is showing."""
+        self._sent_rows = None
+
+    def dirty_ranges(self):
+        """Returns a list of (start row, end row) ranges which need to be
+        sent to the device.
+        """
+        if self._sent_rows is None:
+            return [(0, NUM_ROWS)]
+        runs = []
+        for row in range(NUM_ROWS):
+            if self.rows[row] == self._sent_rows[row]:
+                continue
+            if runs and runs[-1][1] == row:
+                runs[-1] = (runs[-1][0], row + 1)
+            else:
+                runs.append((row, row + 1))
+        ranges = runs[:1]
+        for start, end in runs[1:]:
+            last_start, last_end = ranges[-1]
+            # send the unchanged rows in between when that takes fewer
+            # bytes than another packet
+            if _packet_size(end - last_start) < \
+                    _packet_size(last_end - last_start) + \
+                    _packet_size(end - start):
+                ranges[-1] = (last_start, end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def flush(self):
+        """Sends the rows which have changed since the last flush."""
+        ranges = self.dirty_ranges()
+        if not ranges:
+            return
+        with self.codebug.pipeline():
+            for start, end in ranges:
+                if end - start == 1:
+                    self.codebug.set(start, self.rows[start])
+                else:
+                    self.codebug.set_bulk(start, bytes(self.rows[start:end]))
+        self._sent_rows = bytes(self.rows)
+
+    def clear(self):
+        """Clears the pixels."""
+        self.rows[:] = bytes(NUM_ROWS)
+
+    def fill(self):
+        """Sets all pixels on."""
+        self.rows[:] = bytes([ROW_MASK] * NUM_ROWS)
+
+    def set_row(self, row, val):
+        """Sets a row of pixels."""
+        self.rows[row] = val & 0xff
+
+    def get_row(self, row):
+        """Returns a row of pixels."""
+        return self.rows[row]
+
+    def set_col(self, col, val):
+        """Sets an entire column of pixels."""
+        bit = 1 << (4 - col)
+        for row in range(NUM_ROWS):
+            if (val >> (4 - row)) & 1:
+                self.rows[row] |= bit
+            else:
+                self.rows[row] &= 0xff ^ bit
+
+    def get_col(self, col):
+        """Returns an entire column of pixels."""
+        c = 0
+        for row in self.rows:
+            c = (c << 1) | (1 & (row >> (4 - col)))
+        return c
+
+    def set_pixel(self, x, y, state):
+        """Sets a pixel."""
+        if state:
+            self.rows[y] |= 1 << (4 - x)
+        else:
+            self.rows[y] &= 0xff ^ (1 << (4 - x))
+
+    def get_pixel(self, x, y):
+        """Returns the state of a pixel."""
+        return (self.rows[y] >> (4 - x)) & 1
+
+    def draw_sprite(self, x, y, sprite, clear_first=True):
+        """Draws a sprite at (x, y)."""
+        cb_display_sprite = sprite.get_sprite(-x, -y, 5, 5)
+        for row in range(NUM_ROWS):
+            value = cb_display_sprite.get_row(row)
+            if clear_first:
+                self.rows[row] = value
+            else:
+                self.rows[row] |= value
+
+    def scroll_sprite(self, sprite, interval=0.1, direction='L'):
+        """Scrolls a sprite (or ScrollSequence or LazyStringSprite),
+        flushing after each step. Steps which don't change the display
+        cost nothing.
+        """
+        def render(frame):
+            self.rows[:] = frame
+            self.flush()
+
+        FrameScheduler(interval).play(scroll_frames(sprite, direction),
+                                      render)
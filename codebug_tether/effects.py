@@ -0,0 +1,156 @@
+"""Colour tail effects, worked out up front.
+
+Every frame of an effect is calculated when the effect is made and
+stored as GRB bytes (the order they are sent to the strip), so playing
+it only copies bytes into the colour tail and uploads them:
+
+    from codebug_tether import CodeBug
+    from codebug_tether.colourtail import CodeBugColourTail
+    from codebug_tether import effects
+
+    codebug = CodeBug()
+    colourtail = CodeBugColourTail(codebug)
+    colourtail.init()
+
+    rainbow = effects.rainbow(colourtail.length)
+    rainbow = rainbow.corrected(gamma=2.2, brightness=0.25)
+    colourtail.play(rainbow, interval=1/60, repeat=10)
+
+    pulse = (effects.fade(colourtail.length, (0, 0, 0), (255, 0, 0)) +
+             effects.breathe(colourtail.length, (255, 0, 0)))
+    colourtail.play(pulse)
+
+Frames are blended with NumPy if it is installed.
+"""
+import math
+import colorsys
+from .colourtail import colour_lut
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Effect():
+    """The frames of a colour tail animation for a strip of length
+    pixels, stored one after another in `frames`.
+    """
+
+    def __init__(self, length, frames):
+        self.length = length
+        self.frame_size = 3 * length
+        self.frames = bytes(frames)
+        if len(self.frames) % self.frame_size:
+            raise ValueError(
+                'frames must be whole frames of {} pixels.'.format(length))
+
+    def __len__(self):
+        return len(self.frames) // self.frame_size
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame index out of range')
+        start = index * self.frame_size
+        return self.frames[start:start+self.frame_size]
+
+    def __iter__(self):
+        frames = memoryview(self.frames)
+        for start in range(0, len(frames), self.frame_size):
+            yield frames[start:start+self.frame_size]
+
+    def __add__(self, other):
+        if other.length != self.length:
+            raise ValueError('Effects are for different length strips.')
+        return Effect(self.length, self.frames + other.frames)
+
+    def corrected(self, gamma=1.0, brightness=1.0):
+        """Returns the effect gamma corrected and scaled by brightness
+        (0-1).
+        """
+        return Effect(self.length,
+                      self.frames.translate(colour_lut(gamma, brightness)))
+
+
+def _grb(colour):
+    red, green, blue = colour
+    return bytes((green, red, blue))
+
+
+def _blend(start, end, t):
+    """Returns bytes between start (t = 0) and end (t = 1)."""
+    return bytes(int(round(a + (b - a) * t)) for a, b in zip(start, end))
+
+
+def crossfade(start, end, steps=60):
+    """Returns an Effect which blends from the GRB frame start to end in
+    steps frames.
+    """
+    if len(start) != len(end):
+        raise ValueError('Frames are for different length strips.')
+    if numpy is not None:
+        start_array = numpy.frombuffer(bytes(start), dtype=numpy.uint8)
+        end_array = numpy.frombuffer(bytes(end), dtype=numpy.uint8)
+        t = numpy.arange(steps)[:, None] / max(1, steps - 1)
+        frames = numpy.rint(start_array + (end_array.astype(float) -
+                                           start_array) * t)
+        frames = frames.astype(numpy.uint8).tobytes()
+    else:
+        frames = b''.join(_blend(start, end, i / max(1, steps - 1))
+                          for i in range(steps))
+    return Effect(len(start) // 3, frames)
+
+
+def fade(length, start_colour, end_colour, steps=60):
+    """Returns an Effect which fades every pixel from one (red, green,
+    blue) colour to another.
+    """
+    return crossfade(_grb(start_colour) * length, _grb(end_colour) * length,
+                     steps)
+
+
+def breathe(length, colour, steps=120, minimum=0.0):
+    """Returns an Effect which brightens every pixel from minimum (0-1)
+    to colour and back again, smoothly.
+    """
+    grb = _grb(colour)
+    frames = []
+    for i in range(steps):
+        level = minimum + (1 - minimum) * (1 - math.cos(
+            2 * math.pi * i / steps)) / 2
+        frames.append(_blend(bytes(3), grb, level) * length)
+    return Effect(length, b''.join(frames))
+
+
+def rainbow(length, steps=None, saturation=1.0, value=1.0):
+    """Returns an Effect which turns a rainbow along the strip once,
+    taking steps frames (default: one frame per pixel).
+    """
+    if steps is None:
+        steps = length
+    wheel = [_grb(int(round(255 * c))
+                  for c in colorsys.hsv_to_rgb(i / steps, saturation, value))
+             for i in range(steps)]
+    offsets = [pixel * steps // length for pixel in range(length)]
+    return Effect(length, b''.join(wheel[(i + offset) % steps]
+                                   for i in range(steps)
+                                   for offset in offsets))
+
+
+def chase(length, colour, tail=4, background=(0, 0, 0)):
+    """Returns an Effect where a pixel of colour, followed by a fading
+    tail, runs along the strip.
+    """
+    background = _grb(background)
+    colour = _grb(colour)
+    tail_pixels = [_blend(background, colour, (tail - i) / tail)
+                   for i in range(min(tail, length))]
+    frames = []
+    for head in range(length):
+        frame = bytearray(background * length)
+        for i, pixel in enumerate(tail_pixels):
+            position = 3 * ((head - i) % length)
+            frame[position:position+3] = pixel
+        frames.append(bytes(frame))
+    return Effect(length, b''.join(frames))
@@ -0,0 +1,468 @@
+"""A pure Python CodeBug for testing and benchmarking without hardware.
+
+CodeBugEmulator implements the channel and buffer protocol of the tether
+firmware (GET, SET, GET/SET BULK, AND, OR, GET/SET BUFFER) along with the
+peripherals behind the channels. FakeSerialPort wraps an emulator in the
+parts of the pyserial interface that codebug_tether uses, so it can be
+passed straight to CodeBug or SerialChannelDevice. For example:
+
+    from codebug_tether import CodeBug
+    from codebug_tether.emulator import FakeSerialPort
+
+    port = FakeSerialPort()
+    codebug = CodeBug(port)
+    codebug.set_pixel(2, 2, 1)
+    print(port.emulator)
+
+Peripherals are pluggable. Replace `emulator.spi`, `emulator.i2c`,
+`emulator.uart` or `emulator.colourtail` with your own models.
+"""
+import os
+import time
+from .serial_channel_device import (ACK_BYTE,
+                                    NUM_CHANNELS,
+                                    CMD_GET,
+                                    CMD_SET,
+                                    CMD_GET_BULK,
+                                    CMD_SET_BULK,
+                                    CMD_AND,
+                                    CMD_OR,
+                                    CMD_GET_BUFFER,
+                                    CMD_SET_BUFFER,
+                                    packet_length)
+from .i2c import (I2C_CONTROL_GO_BUSY, I2C_CONTROL_READ_NOT_WRITE)
+from .core import (BUFFER_SIZE,
+                   UART_TX_BUFFER_INDEX,
+                   UART_RX_BUFFER_INDEX,
+                   UART_TX_GO_BUSY_MASK,
+                   UART_RX_GO_BUSY_MASK,
+                   CHANNEL_INDEX_LEG_INPUT,
+                   CHANNEL_INDEX_BUTTON_INPUT,
+                   CHANNEL_INDEX_ANALOGUE_CONF,
+                   CHANNEL_INDEX_ANALOGUE_INPUT,
+                   CHANNEL_INDEX_SPI_LENGTH,
+                   CHANNEL_INDEX_SPI_CONTROL,
+                   CHANNEL_INDEX_I2C_ADDR,
+                   CHANNEL_INDEX_I2C_LENGTH,
+                   CHANNEL_INDEX_I2C_CONTROL,
+                   CHANNEL_INDEX_UART_RX_OFFSET,
+                   CHANNEL_INDEX_UART_RX_LENGTH,
+                   CHANNEL_INDEX_UART_TX_OFFSET,
+                   CHANNEL_INDEX_UART_TX_LENGTH,
+                   CHANNEL_INDEX_UART_CONTROL,
+                   CHANNEL_INDEX_COLOURTAIL_LENGTH,
+                   CHANNEL_INDEX_COLOURTAIL_CONTROL)
+
+
+NUM_BUFFERS = 2
+
+SPI_CONTROL_GO_BUSY = 0x01
+COLOURTAIL_CONTROL_GO_BUSY = 0x01
+COLOURTAIL_CONTROL_INIT_NOT_UPDATE = 0x02
+
+# UART control bits 2-4 select the baud rate
+UART_BAUD_RATES = (300, 1200, 2400, 9600, 10417, 19200, 57600, 115200)
+
+
+class SPIPeripheral():
+    """An SPI bus with nothing on it (MISO floats high). Override
+    `transfer` to model a device.
+    """
+
+    def __init__(self):
+        self.transfers = []
+
+    def transfer(self, data, control):
+        """Called with the bytes clocked out on MOSI. Returns the bytes
+        clocked in on MISO.
+        """
+        self.transfers.append(bytes(data))
+        return bytes([0xff] * len(data))
+
+
+class I2CPeripheral():
+    """An I2C bus with nothing on it. Override `write` and `read` to
+    model devices.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def write(self, address, data, control):
+        """Called with the bytes written to address."""
+        self.messages.append(('write', address, bytes(data)))
+
+    def read(self, address, length, control):
+        """Returns `length` bytes read from address."""
+        self.messages.append(('read', address, length))
+        return bytes([0xff] * length)
+
+
+class I2CRegisterDevice():
+    """Models an I2C device with 8-bit registers and an auto-incrementing
+    register pointer. The first byte of a write sets the pointer, any
+    other bytes are written to the registers. Pass one or more of these
+    to I2CBus.
+    """
+
+    def __init__(self, address, registers=None):
+        self.address = address
+        self.registers = bytearray(256)
+        if registers:
+            for register, value in registers.items():
+                self.registers[register] = value
+        self.pointer = 0
+
+    def write(self, data):
+        if data:
+            self.pointer = data[0]
+            for value in data[1:]:
+                self.registers[self.pointer] = value
+                self.pointer = (self.pointer + 1) & 0xff
+
+    def read(self, length):
+        values = bytearray()
+        for i in range(length):
+            values.append(self.registers[self.pointer])
+            self.pointer = (self.pointer + 1) & 0xff
+        return bytes(values)
+
+
+class I2CBus(I2CPeripheral):
+    """An I2C bus with I2CRegisterDevices on it."""
+
+    def __init__(self, *devices):
+        super().__init__()
+        self.devices = {device.address: device for device in devices}
+
+    def write(self, address, data, control):
+        super().write(address, data, control)
+        if address in self.devices:
+            self.devices[address].write(data)
+
+    def read(self, address, length, control):
+        if address in self.devices:
+            self.messages.append(('read', address, length))
+            return self.devices[address].read(length)
+        return super().read(address, length, control)
+
+
+class UARTPeripheral():
+    """Records transmitted bytes and queues bytes to be received. Call
+    `feed` to send bytes to CodeBug. Like a real UART line, bytes arrive
+    whether or not CodeBug is receiving, and the ones which arrive while
+    RX isn't armed are dropped.
+    """
+
+    def __init__(self):
+        self.transmitted = bytearray()
+        self.rx_queue = bytearray()
+
+    def feed(self, data):
+        """Queues data for CodeBug to receive."""
+        self.rx_queue += data
+
+    def transmit(self, data, baud):
+        """Called with the bytes CodeBug has finished transmitting."""
+        self.transmitted += data
+
+
+class ColourTailPeripheral():
+    """Records the frames sent to a colour tail as lists of (red, green,
+    blue) tuples.
+    """
+
+    def __init__(self):
+        self.use_leg_0_not_cs = False
+        self.frames = []
+
+    def init(self, use_leg_0_not_cs):
+        self.use_leg_0_not_cs = use_leg_0_not_cs
+
+    def show(self, grb_bytes):
+        """Called with the bytes sent to the strip (green, red, blue)."""
+        self.frames.append([(grb_bytes[i+1], grb_bytes[i], grb_bytes[i+2])
+                            for i in range(0, len(grb_bytes) - 2, 3)])
+
+    @property
+    def pixels(self):
+        """The last frame sent to the strip."""
+        return self.frames[-1] if self.frames else []
+
+
+class CodeBugEmulator():
+    """Emulates a CodeBug running the tether firmware.
+
+    Packets are passed to `handle` as bytes and the response (ACK and any
+    data) is returned as bytes. Partial packets are kept until the rest
+    arrives.
+
+    Inputs can be changed with `set_input` and `analogue_values`. UART
+    transmit and receive take as long as they would at the configured
+    baud rate, unless `uart_timing` is False (then everything fed to the
+    UART arrives at the next packet).
+    """
+
+    def __init__(self, buffer_size=BUFFER_SIZE, uart_timing=True):
+        self.channels = bytearray(NUM_CHANNELS)
+        self.buffers = [bytearray(buffer_size) for i in range(NUM_BUFFERS)]
+        self.analogue_values = [0] * 8
+        self.uart_timing = uart_timing
+        self.spi = SPIPeripheral()
+        self.i2c = I2CPeripheral()
+        self.uart = UARTPeripheral()
+        self.colourtail = ColourTailPeripheral()
+        self.packets = []
+        self._partial = bytearray()
+        self._uart_tx_done_at = None
+        self._uart_tx_data = None
+        self._uart_rx_last = 0
+
+    def __str__(self):
+        return '\n'.join('{:05b}'.format(row & 0x1f)
+                         for row in self.channels[:5]).replace(
+                             '0', '.').replace('1', '#')
+
+    def set_input(self, input_index, state):
+        """Sets the state of an input. 'A' and 'B' are the buttons,
+        0-7 are the legs.
+        """
+        if isinstance(input_index, str):
+            input_index = 8 if 'a' in input_index.lower() else 9
+        if input_index > 7:
+            channel_index = CHANNEL_INDEX_BUTTON_INPUT
+            input_index -= 8
+        else:
+            channel_index = CHANNEL_INDEX_LEG_INPUT
+        if state:
+            self.channels[channel_index] |= 1 << input_index
+        else:
+            self.channels[channel_index] &= 0xff ^ (1 << input_index)
+
+    def handle(self, data):
+        """Handles the packets in data and returns the response bytes."""
+        self._partial += data
+        response = bytearray()
+        while True:
+            length = packet_length(self._partial)
+            if length is None or len(self._partial) < length:
+                break
+            packet = bytes(self._partial[:length])
+            del self._partial[:length]
+            self.packets.append(packet)
+            response += self.handle_packet(packet)
+        return bytes(response)
+
+    def handle_packet(self, packet):
+        """Handles one packet and returns the response bytes."""
+        self.update()
+        command = packet[0] >> 5
+        index = packet[0] & 0x1f
+        if command == CMD_GET:
+            return ACK_BYTE + self._get_channels(index, 1)
+        elif command == CMD_SET:
+            self._set_channels(index, packet[1:2])
+        elif command == CMD_GET_BULK:
+            return ACK_BYTE + self._get_channels(index, packet[1])
+        elif command == CMD_SET_BULK:
+            self._set_channels(index, packet[2:])
+        elif command == CMD_AND:
+            self._set_channels(index, (self.channels[index] & packet[1],))
+        elif command == CMD_OR:
+            self._set_channels(index, (self.channels[index] | packet[1],))
+        elif command == CMD_GET_BUFFER:
+            offset, length = packet[1], packet[2]
+            buf = self.buffers[index % NUM_BUFFERS]
+            data = bytes(buf[offset:offset+length])
+            return ACK_BYTE + data + bytes(length - len(data))
+        elif command == CMD_SET_BUFFER:
+            offset, data = packet[1], packet[3:]
+            buf = self.buffers[index % NUM_BUFFERS]
+            data = data[:max(0, len(buf) - offset)]
+            buf[offset:offset+len(data)] = data
+        return ACK_BYTE
+
+    def update(self):
+        """Moves the UART along to the current time."""
+        now = time.monotonic()
+        if self._uart_tx_done_at is not None and \
+                (not self.uart_timing or now >= self._uart_tx_done_at):
+            self.uart.transmit(self._uart_tx_data, self._uart_baud())
+            self._uart_tx_done_at = None
+            self.channels[CHANNEL_INDEX_UART_CONTROL] &= \
+                0xff ^ UART_TX_GO_BUSY_MASK
+        if not self.uart.rx_queue:
+            # the line is idle
+            self._uart_rx_last = now
+        elif self.uart_timing:
+            byte_time = 10 / self._uart_baud()
+            count = int((now - self._uart_rx_last) / byte_time)
+            self._uart_rx_last += count * byte_time
+            self._uart_receive(count)
+        else:
+            self._uart_receive(len(self.uart.rx_queue))
+
+    def _get_channels(self, channel_index, length):
+        values = bytes(self.channels[channel_index:channel_index+length])
+        return values + bytes(length - len(values))
+
+    def _set_channels(self, channel_index, values):
+        values = bytes(values)[:NUM_CHANNELS - channel_index]
+        self.channels[channel_index:channel_index+len(values)] = values
+        written = range(channel_index, channel_index + len(values))
+        if CHANNEL_INDEX_ANALOGUE_CONF in written:
+            leg = self.channels[CHANNEL_INDEX_ANALOGUE_CONF] & 0x7
+            self.channels[CHANNEL_INDEX_ANALOGUE_INPUT] = \
+                self.analogue_values[leg] & 0xff
+        if CHANNEL_INDEX_SPI_CONTROL in written:
+            self._spi_go()
+        if CHANNEL_INDEX_I2C_CONTROL in written:
+            self._i2c_go()
+        if CHANNEL_INDEX_UART_CONTROL in written:
+            self._uart_go()
+        if CHANNEL_INDEX_COLOURTAIL_CONTROL in written:
+            self._colourtail_go()
+
+    def _spi_go(self):
+        control = self.channels[CHANNEL_INDEX_SPI_CONTROL]
+        if control & SPI_CONTROL_GO_BUSY:
+            length = self.channels[CHANNEL_INDEX_SPI_LENGTH]
+            buf = self.buffers[0]
+            buf[:length] = self.spi.transfer(bytes(buf[:length]), control)
+            self.channels[CHANNEL_INDEX_SPI_CONTROL] = \
+                control & (0xff ^ SPI_CONTROL_GO_BUSY)
+
+    def _i2c_go(self):
+        control = self.channels[CHANNEL_INDEX_I2C_CONTROL]
+        if control & I2C_CONTROL_GO_BUSY:
+            address = self.channels[CHANNEL_INDEX_I2C_ADDR]
+            length = self.channels[CHANNEL_INDEX_I2C_LENGTH]
+            buf = self.buffers[0]
+            if control & I2C_CONTROL_READ_NOT_WRITE:
+                buf[:length] = self.i2c.read(address, length, control)
+            else:
+                self.i2c.write(address, bytes(buf[:length]), control)
+            self.channels[CHANNEL_INDEX_I2C_CONTROL] = \
+                control & (0xff ^ I2C_CONTROL_GO_BUSY)
+
+    def _uart_baud(self):
+        control = self.channels[CHANNEL_INDEX_UART_CONTROL]
+        return UART_BAUD_RATES[(control >> 2) & 0x7]
+
+    def _uart_go(self):
+        control = self.channels[CHANNEL_INDEX_UART_CONTROL]
+        if control & UART_TX_GO_BUSY_MASK and self._uart_tx_done_at is None:
+            offset = self.channels[CHANNEL_INDEX_UART_TX_OFFSET]
+            length = self.channels[CHANNEL_INDEX_UART_TX_LENGTH]
+            buf = self.buffers[UART_TX_BUFFER_INDEX]
+            self._uart_tx_data = bytes(buf[offset:offset+length])
+            self._uart_tx_done_at = (time.monotonic() +
+                                     length * 10 / self._uart_baud())
+        self.update()
+
+    def _uart_receive(self, count):
+        """Receives the next count bytes from the UART into the RX
+        buffer. The RX offset and length channels track where the next
+        byte goes and how many are left. Bytes which arrive while RX
+        isn't armed are dropped.
+        """
+        buf = self.buffers[UART_RX_BUFFER_INDEX]
+        data = self.uart.rx_queue[:count]
+        del self.uart.rx_queue[:count]
+        for value in data:
+            control = self.channels[CHANNEL_INDEX_UART_CONTROL]
+            if not (control & UART_RX_GO_BUSY_MASK and
+                    self.channels[CHANNEL_INDEX_UART_RX_LENGTH]):
+                continue
+            offset = self.channels[CHANNEL_INDEX_UART_RX_OFFSET]
+            buf[offset % len(buf)] = value
+            self.channels[CHANNEL_INDEX_UART_RX_OFFSET] = (offset + 1) & 0xff
+            self.channels[CHANNEL_INDEX_UART_RX_LENGTH] -= 1
+            if self.channels[CHANNEL_INDEX_UART_RX_LENGTH] == 0:
+                self.channels[CHANNEL_INDEX_UART_CONTROL] &= \
+                    0xff ^ UART_RX_GO_BUSY_MASK
+
+    def _colourtail_go(self):
+        control = self.channels[CHANNEL_INDEX_COLOURTAIL_CONTROL]
+        if control & COLOURTAIL_CONTROL_GO_BUSY:
+            if control & COLOURTAIL_CONTROL_INIT_NOT_UPDATE:
+                self.colourtail.init(bool(control & 0x04))
+            else:
+                length = self.channels[CHANNEL_INDEX_COLOURTAIL_LENGTH]
+                self.colourtail.show(bytes(self.buffers[0][:length*3]))
+            self.channels[CHANNEL_INDEX_COLOURTAIL_CONTROL] = \
+                control & (0xff ^ COLOURTAIL_CONTROL_GO_BUSY)
+
+
+class FakeSerialPort():
+    """A serial port with a CodeBugEmulator on the other end.
+
+    Args:
+        emulator: The CodeBugEmulator to talk to (a new one by default).
+        baudrate: If set, writes take as long as sending the packets and
+            their responses would at this baud rate.
+        latency: Seconds added to every write, like a USB round trip.
+
+    """
+
+    def __init__(self, emulator=None, baudrate=None, latency=0, timeout=2):
+        self.emulator = emulator if emulator is not None else \
+            CodeBugEmulator()
+        self.baudrate = baudrate
+        self.latency = latency
+        self.timeout = timeout
+        self.is_open = True
+        self._rx_buffer = bytearray()
+        self._pipe = None
+
+    @property
+    def in_waiting(self):
+        return len(self._rx_buffer)
+
+    def write(self, data):
+        response = self.emulator.handle(bytes(data))
+        delay = self.latency
+        if self.baudrate:
+            # 10 bits per byte (start, 8 data, stop)
+            delay += (len(data) + len(response)) * 10 / self.baudrate
+        if delay:
+            time.sleep(delay)
+        self._rx_buffer += response
+        if response and self._pipe is not None:
+            os.write(self._pipe[1], b'\x00')
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self._rx_buffer[:size])
+        del self._rx_buffer[:size]
+        if self._pipe is not None and not self._rx_buffer:
+            try:
+                while os.read(self._pipe[0], 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        return data
+
+    def fileno(self):
+        """Returns a file descriptor which is readable whenever there is
+        response data waiting (for asyncio).
+        """
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            os.set_blocking(self._pipe[0], False)
+            if self._rx_buffer:
+                os.write(self._pipe[1], b'\x00')
+        return self._pipe[0]
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self.read(len(self._rx_buffer))
+
+    def close(self):
+        self.is_open = False
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+            self._pipe = None
@@ -7,6 +7,38 @@ class Font(object):
     def get_char_map(self, character):
         raise NotImplementedError("This is a placeholder font.")
 
+    def get_glyph(self, character):
+        """Returns character as a tuple of row bitmasks, in the order of
+        Sprite rows (the last row of the char map first). Glyphs are
+        worked out once per font and then reused.
+        """
+        try:
+            return self._glyphs[character]
+        except AttributeError:
+            # the cache is made on first use, so subclasses needn't call
+            # Font.__init__
+            self._glyphs = {}
+        except KeyError:
+            pass
+        glyph = tuple(reversed(self.get_char_map(character)))
+        self._glyphs[character] = glyph
+        return glyph
+
+    def get_glyph_bits(self, character):
+        """Returns the rows of character's glyph followed by a 1 pixel
+        space as strings of binary digits, for joining into long rows.
+        """
+        try:
+            return self._glyph_bits[character]
+        except AttributeError:
+            self._glyph_bits = {}
+        except KeyError:
+            pass
+        bits = tuple(format(row << 1, '0{}b'.format(self.char_width + 1))
+                     for row in self.get_glyph(character))
+        self._glyph_bits[character] = bits
+        return bits
+
 
 class FourByFiveFont(Font):
 
@@ -55,6 +55,143 @@ class CodeBugI2CMaster():
         return [bytes(self.codebug.i2c_transaction(*msgs))]
 
 
+class CodeBugI2CRegisterCache(CodeBugI2CMaster):
+    """A CodeBugI2CMaster which remembers the values of registers which
+    only change when they are written (configuration registers), for
+    devices with an auto-incrementing register pointer (most sensors).
+
+    Register writes and reads in `transaction` are followed so that
+    writes to cached registers are written through to the cache, and a
+    transaction which only reads cached registers is answered without
+    using the bus. `read` merges adjacent registers into one burst and
+    sends all of the bursts in one transaction. For example:
+
+        import codebug_tether
+        from codebug_tether.i2c import (CodeBugI2CRegisterCache, reading,
+                                        writing)
+
+        codebug = codebug_tether.CodeBug()
+        codebug.config_extension_i2c()
+        i2c = CodeBugI2CRegisterCache(codebug, {0x1c: range(0x0e, 0x30)})
+
+        # the first read goes to the bus, the rest come from the cache
+        i2c.transaction(writing(0x1c, (0x2a,)), reading(0x1c, 1))
+        # written through to the cache
+        i2c.transaction(writing(0x1c, (0x2a, 0x01)))
+        # data registers 0x01-0x06 in one burst, 0x2a from the cache
+        x_msb, x_lsb, y_msb, y_lsb, z_msb, z_lsb, ctrl = i2c.read(
+            0x1c, (0x01, 0x02, 0x03, 0x04, 0x05, 0x06, 0x2a))
+
+    """
+    def __init__(self, codebug, cacheable=None):
+        """
+        :param codebug: The CodeBug through which to send I2C data.
+        :type codebug: `codebug_tether.core.CodeBug`
+        :param cacheable: Device address: registers which can be cached.
+        :type cacheable: dict
+        """
+        super().__init__(codebug)
+        # address: set of registers
+        self._cacheable = {}
+        # address: {register: value}
+        self._cache = {}
+        for address, registers in (cacheable or {}).items():
+            self.set_cacheable(address, registers)
+
+    def set_cacheable(self, address, registers):
+        """Adds registers to the ones which can be cached for the device
+        at address.
+        """
+        self._cacheable.setdefault(address, set()).update(registers)
+        self._cache.setdefault(address, {})
+
+    def invalidate(self, address=None):
+        """Forgets the cached registers (of one device or all of them)."""
+        for cache_address, cache in self._cache.items():
+            if address is None or address == cache_address:
+                cache.clear()
+
+    def _cached(self, address, register, length):
+        """Returns the cached values of length registers from register,
+        or None if they aren't all cached.
+        """
+        cache = self._cache.get(address)
+        if not cache:
+            return None
+        values = [cache.get(register + i) for i in range(length)]
+        if None in values:
+            return None
+        return bytes(values)
+
+    def _update(self, address, register, values):
+        cacheable = self._cacheable.get(address)
+        if not cacheable:
+            return
+        for i, value in enumerate(values):
+            if register + i in cacheable:
+                self._cache[address][register + i] = value
+
+    def transaction(self, *msgs):
+        # a register pointer write followed by a read of cached registers
+        if len(msgs) == 2 and len(msgs[0].data) == 1 and \
+                not msgs[0].control & I2C_CONTROL_READ_NOT_WRITE and \
+                msgs[1].control & I2C_CONTROL_READ_NOT_WRITE and \
+                msgs[0].address == msgs[1].address:
+            values = self._cached(msgs[0].address, msgs[0].data[0],
+                                  msgs[1].length)
+            if values is not None:
+                return [values]
+        data = super().transaction(*msgs)[0]
+        # follow the register pointers to keep the cache up to date
+        pointers = {}
+        read_offset = 0
+        for msg in msgs:
+            register = pointers.get(msg.address)
+            if msg.control & I2C_CONTROL_READ_NOT_WRITE:
+                values = data[read_offset:read_offset+msg.length]
+                read_offset += msg.length
+            elif msg.data:
+                register = msg.data[0]
+                values = bytes(msg.data[1:])
+            else:
+                continue
+            if register is not None:
+                self._update(msg.address, register, values)
+                pointers[msg.address] = register + len(values)
+        return [data]
+
+    def read(self, address, registers):
+        """Returns the values of registers as a tuple. Registers which
+        aren't cached are read from the bus, adjacent ones in a single
+        burst, all in one transaction.
+        """
+        cache = self._cache.get(address, {})
+        values = dict(cache)
+        bursts = []
+        for register in sorted(set(registers) - set(cache)):
+            if bursts and bursts[-1][0] + bursts[-1][1] == register:
+                bursts[-1][1] += 1
+            else:
+                bursts.append([register, 1])
+        if bursts:
+            msgs = []
+            for register, length in bursts:
+                msgs.append(writing(address, (register,)))
+                msgs.append(reading(address, length))
+            data = CodeBugI2CMaster.transaction(self, *msgs)[0]
+            offset = 0
+            for register, length in bursts:
+                burst = data[offset:offset+length]
+                offset += length
+                self._update(address, register, burst)
+                values.update(zip(range(register, register + length), burst))
+        return tuple(values[register] for register in registers)
+
+    def write(self, address, register, values):
+        """Writes values to the registers from register onwards."""
+        self.transaction(writing(address, (register,) + tuple(values)))
+
+
 class I2CMessage():
     """Data structure for building I2C message patterns."""
 
@@ -0,0 +1,183 @@
+"""Watches CodeBug's legs and buttons for changes.
+
+Reading every input with `get_input` takes one round trip each.
+InputWatcher reads the legs and buttons together with one GET BULK per
+poll and calls back when an input changes:
+
+    from codebug_tether import CodeBug
+    from codebug_tether.inputs import InputWatcher
+
+    codebug = CodeBug(threadsafe=True)
+    with InputWatcher(codebug, interval=0.01, debounce=0.02) as inputs:
+        inputs.on_rising('A', lambda index: print('A pressed'))
+        inputs.on_falling(0, lambda index: print('leg 0 went low'))
+        input('Press enter to stop')
+
+Events can also be read with `async for`:
+
+    async for event in inputs:
+        print(event.input_index, event.state)
+
+The watcher polls from its own thread, so use a CodeBug made with
+`threadsafe=True` if anything else uses it at the same time.
+"""
+import time
+import asyncio
+import threading
+from collections import (deque, namedtuple)
+from .core import (CHANNEL_INDEX_LEG_INPUT,
+                   CodeBug)
+from .waiters import AsyncWaiters
+
+
+# legs are bits 0-7 of a snapshot, the buttons are bits 8 and 9
+NUM_INPUTS = 10
+INPUT_A = 8
+INPUT_B = 9
+
+InputEvent = namedtuple('InputEvent', 'input_index state time')
+
+
+def read_inputs(codebug):
+    """Returns the state of every input as one bitmask, read with one
+    GET BULK of the leg and button channels.
+    """
+    legs, buttons = codebug.get_bulk(CHANNEL_INDEX_LEG_INPUT, 2)
+    return legs | (buttons & 0x3) << 8
+
+
+class InputWatcher():
+    """Polls the inputs every interval seconds and calls back on rising
+    and falling edges. A change only counts once the input has stayed
+    the same for debounce seconds.
+
+    `state` is the debounced state of every input as a bitmask (see
+    `snapshot`). Events are kept for `async for` in a queue of up to
+    max_events (the oldest are dropped).
+    """
+
+    def __init__(self, codebug, interval=0.01, debounce=0.02,
+                 max_events=256, clock=time.monotonic):
+        self.codebug = codebug
+        self.interval = interval
+        self.debounce = debounce
+        self.clock = clock
+        self.state = None
+        self.error = None
+        self._raw = None
+        self._changed_at = [0] * NUM_INPUTS
+        self._rising = [[] for i in range(NUM_INPUTS)]
+        self._falling = [[] for i in range(NUM_INPUTS)]
+        self._events = deque(maxlen=max_events)
+        self._waiters = AsyncWaiters()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._closed = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Reads the inputs and starts the polling thread."""
+        self.poll()
+        self._closed = False
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='InputWatcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the polling thread."""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def snapshot(self):
+        """Reads every input and returns them as one bitmask, legs in
+        bits 0-7 and buttons A and B in bits 8 and 9:
+
+            >>> inputs.snapshot() & (1 << INPUT_A)  # A is pressed
+            256
+
+        """
+        return read_inputs(self.codebug)
+
+    def on_rising(self, input_index, callback):
+        """Calls callback(input_index) when input_index ('A', 'B' or a
+        leg) goes high.
+        """
+        self._rising[CodeBug._int_input_index(input_index)].append(callback)
+
+    def on_falling(self, input_index, callback):
+        """Calls callback(input_index) when input_index ('A', 'B' or a
+        leg) goes low.
+        """
+        self._falling[CodeBug._int_input_index(input_index)].append(callback)
+
+    def poll(self):
+        """Reads the inputs, updates `state` and calls back for every
+        input which has changed. Returns the inputs which changed as a
+        bitmask.
+        """
+        raw = self.snapshot()
+        now = self.clock()
+        if self.state is None:
+            self.state = self._raw = raw
+            return 0
+        changed = raw ^ self._raw
+        self._raw = raw
+        stable = 0
+        for index in range(NUM_INPUTS):
+            if changed >> index & 1:
+                self._changed_at[index] = now
+            if now - self._changed_at[index] >= self.debounce:
+                stable |= 1 << index
+        state = (self.state & ~stable) | (raw & stable)
+        edges = state ^ self.state
+        self.state = state
+        for index in range(NUM_INPUTS):
+            if edges >> index & 1:
+                self._edge(index, state >> index & 1, now)
+        return edges
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Returns the next InputEvent."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._events:
+                    return self._events.popleft()
+                if self._closed:
+                    raise StopAsyncIteration
+                future = self._waiters.add(loop)
+            await future
+
+    def _edge(self, index, state, now):
+        with self._lock:
+            self._events.append(InputEvent(index, state, now))
+        self._waiters.wake()
+        callbacks = self._rising if state else self._falling
+        for callback in callbacks[index]:
+            callback(index)
+
+    def _run(self):
+        try:
+            while not self._stopping.wait(self.interval):
+                self.poll()
+        except Exception as error:
+            self.error = error
+        finally:
+            with self._lock:
+                self._closed = True
+            self._waiters.wake()
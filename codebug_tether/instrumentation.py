@@ -0,0 +1,192 @@
+"""Observers for the packets a SerialChannelDevice sends.
+
+Add them with `add_observer`:
+
+    from codebug_tether import CodeBug
+    from codebug_tether.sprites import StringSprite
+    from codebug_tether.instrumentation import (PacketStats, PacketTrace,
+                                                PacketDump)
+
+    codebug = CodeBug()
+    stats = PacketStats()
+    trace = PacketTrace(maxlen=100)
+    codebug.add_observer(stats)
+    codebug.add_observer(trace)
+    with open('codebug.dump', 'wb') as f:
+        dump = PacketDump(f)
+        codebug.add_observer(dump)
+        codebug.scroll_sprite(StringSprite('Hello'))
+        codebug.remove_observer(dump)
+    print(stats.summary())
+
+Dumps can be read back with `read_dump` and replayed against the library
+with `ReplaySerialPort`.
+"""
+import bisect
+import struct
+from collections import (Counter, deque)
+from .serial_channel_device import (CMD_GET,
+                                    CMD_SET,
+                                    CMD_GET_BULK,
+                                    CMD_SET_BULK,
+                                    CMD_AND,
+                                    CMD_OR,
+                                    CMD_GET_BUFFER,
+                                    CMD_SET_BUFFER,
+                                    PacketEvent,
+                                    packet_length,
+                                    payload_length)
+
+
+COMMAND_NAMES = {CMD_GET: 'GET',
+                 CMD_SET: 'SET',
+                 CMD_GET_BULK: 'GET_BULK',
+                 CMD_SET_BULK: 'SET_BULK',
+                 CMD_AND: 'AND',
+                 CMD_OR: 'OR',
+                 CMD_GET_BUFFER: 'GET_BUFFER',
+                 CMD_SET_BUFFER: 'SET_BUFFER'}
+
+# upper edges of the response time histogram buckets in seconds, the
+# last bucket holds everything slower
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1)
+
+DUMP_MAGIC = b'CBTD\x01'
+DUMP_RECORD = struct.Struct('<dBBffHH')
+
+
+class PacketStats():
+    """Counts packets, commands and bytes and keeps histograms of the
+    time taken for ACKs and data to arrive.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.reset()
+
+    def reset(self):
+        self.packets = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.commands = Counter()
+        self.ack_histogram = [0] * (len(self.buckets) + 1)
+        self.data_histogram = [0] * (len(self.buckets) + 1)
+
+    def __call__(self, event):
+        self.packets += 1
+        self.bytes_written += len(event.tx_bytes)
+        self.bytes_read += len(event.rx_bytes)
+        self.commands[COMMAND_NAMES[event.command]] += 1
+        self.ack_histogram[bisect.bisect_left(self.buckets,
+                                              event.ack_time)] += 1
+        self.data_histogram[bisect.bisect_left(self.buckets,
+                                               event.data_time)] += 1
+
+    def summary(self):
+        """Returns the stats as a dict."""
+        edges = [str(edge) for edge in self.buckets] + ['inf']
+        return {'packets': self.packets,
+                'bytes_written': self.bytes_written,
+                'bytes_read': self.bytes_read,
+                'commands': dict(self.commands),
+                'ack_histogram': dict(zip(edges, self.ack_histogram)),
+                'data_histogram': dict(zip(edges, self.data_histogram))}
+
+
+class PacketTrace():
+    """Keeps the last `maxlen` PacketEvents."""
+
+    def __init__(self, maxlen=1000):
+        self.events = deque(maxlen=maxlen)
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __len__(self):
+        return len(self.events)
+
+    def clear(self):
+        self.events.clear()
+
+
+class PacketDump():
+    """Writes every PacketEvent to a binary file opened for writing."""
+
+    def __init__(self, file):
+        self.file = file
+        self.file.write(DUMP_MAGIC)
+
+    def __call__(self, event):
+        self.file.write(DUMP_RECORD.pack(event.time,
+                                         event.command,
+                                         event.index,
+                                         event.ack_time,
+                                         event.data_time,
+                                         len(event.tx_bytes),
+                                         len(event.rx_bytes)))
+        self.file.write(event.tx_bytes)
+        self.file.write(event.rx_bytes)
+
+
+def read_dump(file):
+    """Yields the PacketEvents in a dump file opened for reading."""
+    if file.read(len(DUMP_MAGIC)) != DUMP_MAGIC:
+        raise ValueError('Not a CodeBug packet dump.')
+    while True:
+        record = file.read(DUMP_RECORD.size)
+        if len(record) < DUMP_RECORD.size:
+            return
+        (time, command, index, ack_time, data_time,
+         tx_length, rx_length) = DUMP_RECORD.unpack(record)
+        tx_bytes = file.read(tx_length)
+        rx_bytes = file.read(rx_length)
+        # rx_bytes includes the ACK
+        yield PacketEvent(time, command, index,
+                          payload_length(tx_bytes, max(0, rx_length - 1)),
+                          tx_bytes, rx_bytes, ack_time, data_time)
+
+
+class ReplaySerialPort():
+    """A serial port which answers with the responses from recorded
+    PacketEvents. Packets written must match the recording, otherwise
+    ValueError is raised.
+    """
+
+    def __init__(self, events):
+        self.events = deque(events)
+        self.timeout = 2
+        self._partial = bytearray()
+        self._rx_buffer = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self._rx_buffer)
+
+    def write(self, data):
+        self._partial += data
+        while True:
+            length = packet_length(self._partial)
+            if length is None or len(self._partial) < length:
+                break
+            tx_bytes = bytes(self._partial[:length])
+            del self._partial[:length]
+            if not self.events:
+                raise ValueError('Recording has no more packets.')
+            event = self.events.popleft()
+            if event.tx_bytes != tx_bytes:
+                raise ValueError('Expected packet {}, got {}.'.format(
+                    event.tx_bytes.hex(), tx_bytes.hex()))
+            self._rx_buffer += event.rx_bytes
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self._rx_buffer[:size])
+        del self._rx_buffer[:size]
+        return data
+
+    def close(self):
+        pass
@@ -0,0 +1,103 @@
+"""Plays animation frames at a steady rate.
+
+Sleeping for the frame interval after drawing each frame adds the time
+spent drawing (mostly waiting for the serial port) to every frame, so
+animations run slower than asked. FrameScheduler works out when each
+frame is due from when the animation started and sleeps until then
+instead:
+
+    from codebug_tether import CodeBug
+    from codebug_tether.colourtail import CodeBugColourTail
+    from codebug_tether.sprites import (StringSprite, compile_scroll)
+
+    codebug = CodeBug()
+    colourtail = CodeBugColourTail(codebug)
+    frames = compile_scroll(StringSprite('Hello'))
+
+    def render(frame):
+        # the display and colour tail change together
+        codebug.set_bulk(0, bytes(frame))
+        colourtail.set_pixel(0, 0, frame[2] * 8, 0)
+        colourtail.update()
+
+    scheduler = codebug.play(frames, 0.05, render)
+    print(scheduler.fps, scheduler.late, scheduler.skipped)
+
+"""
+import time
+
+
+# no frame has been skipped
+_NOTHING = object()
+
+
+class FrameScheduler():
+    """Calls render(frame) for each frame from source, one every interval
+    seconds, timed against a monotonic clock.
+
+    A frame drawn after it was due is counted in `late`. If the next
+    frame is already due by the time a frame would be drawn it is
+    skipped (and counted in `skipped`) so that the animation catches up,
+    unless skip is False. The last frame is always drawn. An interval of
+    0 plays the frames as fast as possible.
+    """
+
+    def __init__(self, interval=0.1, skip=True, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.interval = interval
+        self.skip = skip
+        self.clock = clock
+        self.sleep = sleep
+        self.reset()
+
+    def reset(self):
+        self.frames = 0
+        self.late = 0
+        self.skipped = 0
+        self.elapsed = 0
+
+    @property
+    def fps(self):
+        """The frames drawn per second."""
+        if not self.elapsed:
+            return 0
+        return self.frames / self.elapsed
+
+    def play(self, source, render):
+        """Draws the frames from source (any iterable) and returns once
+        the last one has been shown for interval seconds.
+        """
+        interval = self.interval
+        start = deadline = None
+        # the last frame skipped, drawn if the source ends with it
+        skipped = _NOTHING
+        for frame in source:
+            now = self.clock()
+            if deadline is None:
+                start = deadline = now
+            behind = now - deadline
+            deadline += interval
+            if interval > 0 and behind > 0:
+                if self.skip and behind >= interval:
+                    self.skipped += 1
+                    skipped = frame
+                    continue
+                self.late += 1
+            elif behind < 0:
+                self.sleep(-behind)
+            render(frame)
+            self.frames += 1
+            skipped = _NOTHING
+        if skipped is not _NOTHING:
+            # don't finish on a stale frame
+            self.skipped -= 1
+            self.late += 1
+            render(skipped)
+            self.frames += 1
+        if deadline is None:
+            return
+        now = self.clock()
+        if now < deadline:
+            self.sleep(deadline - now)
+            now = self.clock()
+        self.elapsed += now - start
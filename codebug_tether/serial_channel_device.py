@@ -1,7 +1,13 @@
 '''
 Useful for interacting with serial devices which use channels.
 '''
+import time
+import queue
 import struct
+import threading
+from collections import (Counter, namedtuple)
+from concurrent.futures import Future
+from contextlib import contextmanager
 
 
 ACK_BYTE = bytes((0xCB,))
@@ -15,6 +21,330 @@ CMD_OR = 5
 CMD_GET_BUFFER= 6
 CMD_SET_BUFFER = 7
 
+NUM_CHANNELS = 32
+
+
+def packet_length(data):
+    """Returns the length of the packet at the start of data, or None if
+    there isn't enough of the packet yet to tell.
+    """
+    if len(data) < 1:
+        return None
+    command = data[0] >> 5
+    if command == CMD_GET:
+        return 1
+    elif command in (CMD_SET, CMD_GET_BULK, CMD_AND, CMD_OR):
+        return 2
+    elif command == CMD_SET_BULK:
+        return 2 + data[1] if len(data) >= 2 else None
+    elif command == CMD_GET_BUFFER:
+        return 3
+    else:  # CMD_SET_BUFFER
+        return 3 + data[2] if len(data) >= 3 else None
+
+
+# Packet builders. The packet formats are described in the
+# SerialChannelDevice methods which send them.
+def get_packet(channel_index):
+    """Returns a GET packet as bytes."""
+    return struct.pack('B', CMD_GET << 5 | channel_index & 0x1f)
+
+
+def set_packet(channel_index, value):
+    """Returns a SET packet as bytes."""
+    return struct.pack('BB', CMD_SET << 5 | channel_index & 0x1f, value)
+
+
+def get_bulk_packet(channel_index, length):
+    """Returns a GET BULK packet as bytes."""
+    return struct.pack('BB', CMD_GET_BULK << 5 | channel_index & 0x1f, length)
+
+
+def set_bulk_packet(channel_index, value_bytes):
+    """Returns a SET BULK packet as bytes."""
+    return struct.pack('BB',
+                       CMD_SET_BULK << 5 | channel_index & 0x1f,
+                       len(value_bytes)) + bytes(value_bytes)
+
+
+def and_packet(channel_index, mask):
+    """Returns an AND packet as bytes."""
+    return struct.pack('BB', CMD_AND << 5 | channel_index & 0x1f, mask)
+
+
+def or_packet(channel_index, mask):
+    """Returns an OR packet as bytes."""
+    return struct.pack('BB', CMD_OR << 5 | channel_index & 0x1f, mask)
+
+
+def get_buffer_packet(buffer_index, length, offset=0):
+    """Returns a GET BUFFER packet as bytes."""
+    return struct.pack('BBB',
+                       CMD_GET_BUFFER << 5 | buffer_index & 0x1f,
+                       offset,
+                       length)
+
+
+def set_buffer_packet(buffer_index, value_bytes, offset=0):
+    """Returns a SET BUFFER packet as bytes."""
+    return struct.pack('BBB',
+                       CMD_SET_BUFFER << 5 | buffer_index & 0x1f,
+                       offset,
+                       len(value_bytes)) + bytes(value_bytes)
+
+
+class AckError(AssertionError):
+    """Raised when the device does not acknowledge a packet."""
+    pass
+
+
+# Given to observers for every packet sent. `length` is the number of
+# channel/buffer bytes written or requested, `tx_bytes` and `rx_bytes`
+# are the packet and everything the device sent back for it (ACK and
+# data) and `ack_time`/`data_time` are seconds from the write until
+# the ACK/data arrived.
+PacketEvent = namedtuple('PacketEvent', ['time',
+                                         'command',
+                                         'index',
+                                         'length',
+                                         'tx_bytes',
+                                         'rx_bytes',
+                                         'ack_time',
+                                         'data_time'])
+
+
+def payload_length(tx_bytes, rx_length):
+    """Returns the number of channel/buffer bytes a packet writes or
+    reads.
+    """
+    command = tx_bytes[0] >> 5
+    if command == CMD_SET_BULK:
+        return len(tx_bytes) - 2
+    elif command == CMD_SET_BUFFER:
+        return len(tx_bytes) - 3
+    elif command in (CMD_SET, CMD_AND, CMD_OR):
+        return 1
+    else:
+        return rx_length
+
+
+def split_responses(packets, rx_bytes):
+    """Checks the ACK of each packet in rx_bytes and returns a list
+    containing the response data for each packet. Raises AckError if a
+    packet was not acknowledged.
+
+    Args:
+        packets: Sequence of (tx_bytes, rx_length) tuples.
+        rx_bytes: Everything the device sent back for those packets.
+
+    """
+    responses = []
+    i = 0
+    for packet_number, (tx_bytes, rx_length) in enumerate(packets):
+        # CodeBug will always return an ACK byte
+        if rx_bytes[i:i+1] != ACK_BYTE:
+            raise AckError(
+                'Packet {} of {} ({}) was not acknowledged.'.format(
+                    packet_number + 1, len(packets), tx_bytes.hex()))
+        responses.append(rx_bytes[i+1:i+1+rx_length])
+        i += 1 + rx_length
+    return responses
+
+
+class SerialDispatcher():
+    """Owns a serial port on its own thread so that many threads can
+    share a device.
+
+    Threads `submit` groups of packets and get a Future for the
+    responses. Each time the dispatcher wakes up it sends every group
+    waiting in the queue in one write and reads all of the responses
+    back in one go. Packets in a group are always sent back to back.
+    """
+
+    def __init__(self, serial_port):
+        self.serial_port = serial_port
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._serve,
+                                        name='SerialDispatcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, packets, callback=None):
+        """Queues a group of packets. Returns a Future which resolves to
+        the list of response data for each packet.
+
+        Args:
+            packets: Sequence of (tx_bytes, rx_length) tuples.
+            callback: Called with (packets, responses) on the dispatcher
+                thread before the Future resolves, so callbacks run in
+                the order the packets were sent.
+
+        """
+        future = Future()
+        self._requests.put((packets, future, callback))
+        return future
+
+    def close(self):
+        """Stops the dispatcher thread once the queue is empty."""
+        self._requests.put(None)
+        self._thread.join()
+
+    def _serve(self):
+        closing = False
+        while not closing:
+            requests = [self._requests.get()]
+            while True:
+                try:
+                    requests.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+            if None in requests:
+                closing = True
+                requests = [request for request in requests if request]
+            if requests:
+                self._dispatch(requests)
+
+    def _dispatch(self, requests):
+        try:
+            self.serial_port.write(b''.join(tx_bytes
+                                            for packets, _, _ in requests
+                                            for tx_bytes, _ in packets))
+            rx_bytes = self.serial_port.read(
+                sum(1 + rx_length
+                    for packets, _, _ in requests
+                    for _, rx_length in packets))
+        except Exception as error:
+            for _, future, _ in requests:
+                future.set_exception(error)
+            return
+
+        i = 0
+        for request_number, (packets, future, callback) in \
+                enumerate(requests):
+            rx_length = sum(1 + rx_length for _, rx_length in packets)
+            try:
+                responses = split_responses(packets, rx_bytes[i:i+rx_length])
+            except AckError as error:
+                # we've lost track of the responses, fail the rest too
+                for _, failed_future, _ in requests[request_number:]:
+                    failed_future.set_exception(error)
+                return
+            i += rx_length
+            try:
+                if callback is not None:
+                    callback(packets, responses)
+            except Exception as error:
+                future.set_exception(error)
+            else:
+                future.set_result(responses)
+
+
+class _TransactionState():
+    """Pipeline and batch state of a SerialChannelDevice."""
+
+    def __init__(self):
+        self.pipeline_depth = 0
+        self.pending = []
+        self.batch = None
+
+
+class _ThreadTransactionState(_TransactionState, threading.local):
+    """Pipeline and batch state kept separately for each thread."""
+    pass
+
+
+class ChannelBatch():
+    """Records channel writes and collapses them into the fewest packets.
+
+    Each channel is tracked as a mask of the bits which are known
+    along with their values. SETs make every bit known, AND masks make
+    the cleared bits known and OR masks make the set bits known. When
+    the batch is flushed, channels whose used bits are all known are
+    sent as SET/SET BULK packets (adjacent channels are merged) and
+    the rest are sent as one AND and one OR packet.
+
+    Only channels in `channel_masks` (channel index: used bits) are
+    recorded. Writing any other channel, or any other packet, flushes
+    the batch first so that ordering is kept.
+    """
+
+    def __init__(self, device, channel_masks):
+        self.device = device
+        self.channel_masks = channel_masks
+        # channel index: (known mask, value)
+        self.channels = {}
+
+    def set(self, channel_index, value):
+        """Records a SET. Returns False if the channel isn't batched."""
+        return self._record(channel_index, 0xff, value)
+
+    def set_bulk(self, channel_index, value_bytes):
+        """Records a SET BULK. Returns False if any of the channels
+        aren't batched.
+        """
+        channels = range(channel_index, channel_index + len(value_bytes))
+        if not all(channel in self.channel_masks for channel in channels):
+            self.flush()
+            return False
+        for channel, value in zip(channels, value_bytes):
+            self._record(channel, 0xff, value)
+        return True
+
+    def and_mask(self, channel_index, mask):
+        """Records an AND. Returns False if the channel isn't batched."""
+        return self._record(channel_index, 0xff ^ (mask & 0xff), 0)
+
+    def or_mask(self, channel_index, mask):
+        """Records an OR. Returns False if the channel isn't batched."""
+        return self._record(channel_index, mask & 0xff, mask & 0xff)
+
+    def _record(self, channel_index, known_mask, value):
+        if channel_index not in self.channel_masks:
+            self.flush()
+            return False
+        old_known_mask, old_value = self.channels.get(channel_index, (0, 0))
+        self.channels[channel_index] = (
+            old_known_mask | known_mask,
+            (old_value & (0xff ^ known_mask)) | (value & known_mask))
+        return True
+
+    def flush(self):
+        """Sends the recorded channel writes to the device."""
+        channels, self.channels = self.channels, {}
+        if not channels:
+            return
+        # stop the device from recording the packets we're sending
+        batch, self.device._state.batch = self.device._state.batch, None
+        try:
+            run_start = None
+            run_values = bytearray()
+            for channel in sorted(channels):
+                known_mask, value = channels[channel]
+                used_mask = self.channel_masks[channel]
+                if known_mask & used_mask == used_mask:
+                    # whole value is known, add it to the SET BULK run
+                    if run_start is None or \
+                            run_start + len(run_values) != channel:
+                        self._send_run(run_start, run_values)
+                        run_start, run_values = channel, bytearray()
+                    run_values.append(value)
+                else:
+                    and_mask = value | (0xff ^ known_mask)
+                    or_mask = value & known_mask
+                    if and_mask != 0xff:
+                        self.device.and_mask(channel, and_mask)
+                    if or_mask != 0:
+                        self.device.or_mask(channel, or_mask)
+            self._send_run(run_start, run_values)
+        finally:
+            self.device._state.batch = batch
+
+    def _send_run(self, channel_index, values):
+        if len(values) == 1:
+            self.device.set(channel_index, values[0])
+        elif len(values) > 1:
+            self.device.set_bulk(channel_index, bytes(values))
+
 
 class SerialChannelDevice():
     """A serial device with single-byte channels and several-byte
@@ -42,8 +372,41 @@ class SerialChannelDevice():
     +------------------------------------------------------------------+
     """
 
-    def __init__(self, serial_port):
+    # Channels which only hold state, mapped to the bits they use. Writes
+    # to these channels are coalesced inside `batch`.
+    coalescable_channels = {}
+
+    # Channels which the device changes by itself. These are never kept
+    # in the shadow.
+    volatile_channels = frozenset()
+
+    def __init__(self, serial_port, shadow=False, threadsafe=False):
+        """
+        :param serial_port: The serial port connected to the device.
+        :param shadow: Keep a shadow copy of the channels on the host so
+            that reading non-volatile channels doesn't need a round trip.
+        :type shadow: bool
+        :param threadsafe: Hand the serial port to a `SerialDispatcher`
+            thread so that the device can be used from many threads.
+            Pipelines and batches belong to the thread which opened them.
+        :type threadsafe: bool
+        """
         self.serial_port = serial_port
+        if threadsafe:
+            self._dispatcher = SerialDispatcher(serial_port)
+            self._state = _ThreadTransactionState()
+        else:
+            self._dispatcher = None
+            self._state = _TransactionState()
+        # channel index: value, for the channels we know. It is updated
+        # from the packets in the order they are sent (by the dispatcher
+        # thread in threadsafe mode), holding _shadow_lock.
+        self._shadow = dict() if shadow else None
+        self._shadow_lock = threading.RLock()
+        self._observers = []
+        # buffer index: SET BUFFER packets sent, so that users of a shared
+        # buffer can tell whether anything else has written to it
+        self.buffer_writes = Counter()
 
     def get(self, channel_index):
         """Returns GetPacket as bytes.
@@ -57,10 +420,10 @@ class SerialChannelDevice():
             +--------+---------------+
 
         """
-        self.transaction(
-            struct.pack('B', (CMD_GET << 5) | (channel_index & 0x1f)))
-        # Serial port will now contain channel data
-        return self.serial_port.read(1)
+        if self._shadow is not None:
+            return self.get_bulk(channel_index, 1)
+        # Serial port will return the channel data after the ACK
+        return self.transaction(get_packet(channel_index), 1)
 
     def set(self, channel_index, value):
         """Returns SetPacket as bytes.
@@ -74,10 +437,10 @@ class SerialChannelDevice():
             +--------+---------------+--------+
 
         """
-        self.transaction(
-            struct.pack('BB',
-                        (CMD_SET << 5 | channel_index & 0x1f),
-                        value))
+        batch = self._state.batch
+        if batch is not None and batch.set(channel_index, value):
+            return
+        self.transaction(set_packet(channel_index, value))
 
     def get_bulk(self, channel_index, length):
         """GET BULK packet for retrieving multiple adjacent channel
@@ -90,12 +453,29 @@ class SerialChannelDevice():
             +--------+---------------------+--------+
 
         """
-        self.transaction(
-            struct.pack('BB',
-                        (CMD_GET_BULK << 5 | channel_index & 0x1f),
-                        length))
-        # Serial port will now contain channel data
-        return self.serial_port.read(length)
+        if self._shadow is not None:
+            if self._state.batch is not None:
+                self._state.batch.flush()
+            channels = range(channel_index, channel_index + length)
+            with self._shadow_lock:
+                shadow = self._shadow
+                if self._state.pending:
+                    # see the writes this thread's pipeline is holding
+                    shadow = dict(shadow)
+                    self._apply_packets(shadow, self._state.pending)
+                try:
+                    return bytes(shadow[channel] for channel in channels)
+                except KeyError:
+                    pass
+            if length == 1:
+                tx_bytes = get_packet(channel_index)
+            else:
+                tx_bytes = get_bulk_packet(channel_index, length)
+            # the response is added to the shadow as it is received
+            return self.transaction(tx_bytes, length)
+        # Serial port will return the channel data after the ACK
+        return self.transaction(get_bulk_packet(channel_index, length),
+                                length)
 
     def set_bulk(self, channel_index, value_bytes):
         """SET BULK packet for setting multiple adjacent channel values
@@ -108,10 +488,10 @@ class SerialChannelDevice():
             +--------+-----------------+-----+------------+
 
         """
-        self.transaction(
-            struct.pack('BB',
-                        (CMD_SET_BULK << 5 | channel_index & 0x1f),
-                        len(value_bytes)) + value_bytes)
+        batch = self._state.batch
+        if batch is not None and batch.set_bulk(channel_index, value_bytes):
+            return
+        self.transaction(set_bulk_packet(channel_index, value_bytes))
 
     def and_mask(self, channel_index, mask):
         """Returns AndPacket as bytes.
@@ -125,9 +505,10 @@ class SerialChannelDevice():
             +--------+---------------+-----------+
 
         """
-        self.transaction(
-            struct.pack('B', (CMD_AND << 5 | channel_index & 0x1f)) + \
-            bytes((mask,)))
+        batch = self._state.batch
+        if batch is not None and batch.and_mask(channel_index, mask):
+            return
+        self.transaction(and_packet(channel_index, mask))
 
     def or_mask(self, channel_index, mask):
         """Returns OrPacket as bytes.
@@ -141,9 +522,10 @@ class SerialChannelDevice():
             +--------+---------------+----------+
 
         """
-        self.transaction(
-            struct.pack('B', (CMD_OR << 5 | channel_index & 0x1f)) + \
-            bytes((mask,)))
+        batch = self._state.batch
+        if batch is not None and batch.or_mask(channel_index, mask):
+            return
+        self.transaction(or_packet(channel_index, mask))
 
     def set_bit(self, channel_index, bit_index, state):
         """Sets a bit in a channel to state."""
@@ -167,13 +549,9 @@ class SerialChannelDevice():
             +--------+--------------+--------+--------+
 
         """
-        self.transaction(
-            struct.pack('BBB',
-                        (CMD_GET_BUFFER << 5 | buffer_index & 0x1f),
-                        offset,
-                        length))
-        # Serial port will now contain buffer data
-        return self.serial_port.read(length)
+        # Serial port will return the buffer data after the ACK
+        return self.transaction(
+            get_buffer_packet(buffer_index, length, offset), length)
 
     def set_buffer(self, buffer_index, value_bytes, offset=0):
         """SET BUFFER packet for setting whole buffers.
@@ -185,16 +563,245 @@ class SerialChannelDevice():
             +--------+--------------+--------+--------+------------+
 
         """
-        self.transaction(
-            struct.pack('BBB',
-                        (CMD_SET_BUFFER << 5 | buffer_index & 0x1f),
-                        offset,
-                        len(value_bytes)) + value_bytes)
+        self.buffer_writes[buffer_index] += 1
+        self.transaction(set_buffer_packet(buffer_index, value_bytes, offset))
 
-    def transaction(self, tx_bytes):
-        """Sends a packet and waits for a ACK response."""
-        # Send the packet
-        self.serial_port.write(tx_bytes)
+    def transaction(self, tx_bytes, rx_length=0):
+        """Sends a packet and waits for a ACK response. Returns the
+        `rx_length` data bytes which the device sends after the ACK.
 
-        # CodeBug will always return an ACK byte
-        assert self.serial_port.read(1) == ACK_BYTE
+        Inside a `pipeline` packets which have no response data are
+        queued and sent later, all in one go.
+        """
+        if self._state.batch is not None:
+            # keep the order of writes which the batch is holding back
+            self._state.batch.flush()
+        self._state.pending.append((tx_bytes, rx_length))
+        if self._state.pipeline_depth > 0 and rx_length == 0:
+            return bytes()
+        return self.flush()[-1]
+
+    def transactions(self, packets):
+        """Sends several packets in a single write and then checks all
+        of their ACK responses together. Returns a list containing the
+        response data for each packet.
+
+        Args:
+            packets: Sequence of (tx_bytes, rx_length) tuples.
+
+        The device handles packets in order so this behaves exactly
+        like sending each packet with `transaction`, except that it
+        costs one round trip instead of one per packet.
+        """
+        try:
+            if self._observers:
+                return self._observed_transactions(packets)
+            if self._dispatcher is not None:
+                return self._dispatcher.submit(packets,
+                                               self._responded).result()
+            self.serial_port.write(
+                b''.join(tx_bytes for tx_bytes, _ in packets))
+            rx_bytes = self.serial_port.read(
+                sum(1 + rx_length for _, rx_length in packets))
+            responses = split_responses(packets, rx_bytes)
+            self._responded(packets, responses)
+            return responses
+        except AckError:
+            # we don't know what the device did with the packets
+            self.invalidate()
+            raise
+
+    def send_packets(self, packets):
+        """Sends precomputed (tx_bytes, rx_length) packets in one write,
+        like `transactions`, after any writes which a `pipeline` or
+        `batch` is holding back. Returns the response data for each of
+        packets.
+        """
+        if self._state.batch is not None:
+            self._state.batch.flush()
+        queued, self._state.pending = self._state.pending, []
+        return self.transactions(queued + list(packets))[len(queued):]
+
+    def _observed_transactions(self, packets):
+        """Sends packets like `transactions` but times each response and
+        tells the observers about every packet.
+        """
+        start_time = time.time()
+        start = time.perf_counter()
+        if self._dispatcher is not None:
+            # the dispatcher reads everything in one go
+            responses = self._dispatcher.submit(packets,
+                                                self._responded).result()
+            elapsed = time.perf_counter() - start
+            for (tx_bytes, rx_length), data in zip(packets, responses):
+                self._notify(PacketEvent(
+                    start_time, tx_bytes[0] >> 5, tx_bytes[0] & 0x1f,
+                    payload_length(tx_bytes, rx_length), tx_bytes,
+                    ACK_BYTE + data, elapsed, elapsed))
+            return responses
+
+        self.serial_port.write(b''.join(tx_bytes for tx_bytes, _ in packets))
+        responses = []
+        for packet_number, (tx_bytes, rx_length) in enumerate(packets):
+            ack = self.serial_port.read(1)
+            ack_time = time.perf_counter() - start
+            data = self.serial_port.read(rx_length) if rx_length else bytes()
+            data_time = time.perf_counter() - start
+            self._notify(PacketEvent(
+                start_time, tx_bytes[0] >> 5, tx_bytes[0] & 0x1f,
+                payload_length(tx_bytes, rx_length), tx_bytes, ack + data,
+                ack_time, data_time))
+            if ack != ACK_BYTE:
+                raise AckError(
+                    'Packet {} of {} ({}) was not acknowledged.'.format(
+                        packet_number + 1, len(packets), tx_bytes.hex()))
+            responses.append(data)
+        self._responded(packets, responses)
+        return responses
+
+    def _responded(self, packets, responses):
+        """Called with every group of packets the device has answered,
+        in the order they were sent.
+        """
+        if self._shadow is not None:
+            with self._shadow_lock:
+                self._apply_packets(self._shadow, packets, responses)
+
+    def _notify(self, event):
+        for observer in self._observers:
+            observer(event)
+
+    def add_observer(self, observer):
+        """Calls observer with a `PacketEvent` for every packet sent to
+        the device. See `codebug_tether.instrumentation` for some
+        observers. For example:
+
+            >>> from codebug_tether.instrumentation import PacketStats
+            >>> codebug = CodeBug()
+            >>> stats = PacketStats()
+            >>> codebug.add_observer(stats)
+            >>> codebug.set_pixel(0, 0, 1)
+            >>> stats.packets
+            1
+
+        Observers cost nothing until one is added. While there are
+        observers each response is read separately so that it can be
+        timed.
+        """
+        self._observers.append(observer)
+
+    def remove_observer(self, observer):
+        """Stops calling observer."""
+        self._observers.remove(observer)
+
+    def flush(self):
+        """Sends any packets queued by `pipeline`. Returns a list
+        containing the response data for each packet.
+        """
+        packets, self._state.pending = self._state.pending, []
+        if not packets:
+            return []
+        return self.transactions(packets)
+
+    @contextmanager
+    def pipeline(self):
+        """Queues packets and sends them in one write when the block
+        exits, then checks all of the ACKs together. Anything which
+        reads from the device (`get`, `get_bulk`, `get_buffer`) sends
+        the queue immediately so that reads see earlier writes. For
+        example:
+
+            >>> codebug = CodeBug()
+            >>> with codebug.pipeline():
+            ...     for x in range(5):
+            ...         codebug.set_pixel(x, x, 1)
+
+        Pipelines can be nested, the queue is sent when the outermost
+        block exits.
+        """
+        self._state.pipeline_depth += 1
+        try:
+            yield self
+        finally:
+            self._state.pipeline_depth -= 1
+            if self._state.pipeline_depth == 0:
+                self.flush()
+
+    @contextmanager
+    def batch(self):
+        """Records channel writes and sends them as the fewest packets
+        when the block exits. Repeated writes to the same channel are
+        folded into one final value and adjacent channels are merged
+        into a single SET BULK. For example, this sends one SET BULK:
+
+            >>> codebug = CodeBug()
+            >>> with codebug.batch():
+            ...     for y in range(5):
+            ...         for x in range(5):
+            ...             codebug.set_pixel(x, y, (x + y) % 2)
+
+        Only `coalescable_channels` are batched. Writes to other
+        channels and reads flush the batch first, so the device always
+        sees writes in the order they were made. Everything is sent in
+        a `pipeline`.
+        """
+        if self._state.batch is not None:
+            # already batching
+            yield self
+            return
+        with self.pipeline():
+            self._state.batch = ChannelBatch(self,
+                                             self.coalescable_channels)
+            try:
+                yield self
+            finally:
+                batch, self._state.batch = self._state.batch, None
+                batch.flush()
+
+    def _apply_packets(self, shadow, packets, responses=None):
+        """Updates shadow with the channel writes in packets and, if
+        responses are given, the channels which were read.
+        """
+        for packet_number, (tx_bytes, _) in enumerate(packets):
+            command = tx_bytes[0] >> 5
+            channel_index = tx_bytes[0] & 0x1f
+            if command == CMD_SET:
+                values = tx_bytes[1:2]
+            elif command == CMD_SET_BULK:
+                values = tx_bytes[2:]
+            elif command in (CMD_GET, CMD_GET_BULK) and \
+                    responses is not None:
+                values = responses[packet_number]
+            elif command == CMD_AND and channel_index in shadow:
+                values = (shadow[channel_index] & tx_bytes[1],)
+            elif command == CMD_OR and channel_index in shadow:
+                values = (shadow[channel_index] | tx_bytes[1],)
+            else:
+                continue
+            for channel, value in enumerate(values, start=channel_index):
+                if channel not in self.volatile_channels:
+                    shadow[channel] = value
+
+    def sync(self):
+        """Reloads the shadow from the device in one GET BULK. Use this
+        after the device has been reset.
+        """
+        if self._shadow is not None:
+            self.invalidate()
+            self.get_bulk(0, NUM_CHANNELS)
+
+    def invalidate(self):
+        """Forgets the shadow so that channels are read from the device
+        again.
+        """
+        if self._shadow is not None:
+            with self._shadow_lock:
+                self._shadow.clear()
+
+    def close(self):
+        """Stops the dispatcher thread (if there is one) and closes the
+        serial port.
+        """
+        if self._dispatcher is not None:
+            self._dispatcher.close()
+        self.serial_port.close()
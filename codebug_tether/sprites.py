@@ -1,9 +1,22 @@
 """Sprites are two dimensional drawings/characters/letters."""
+import functools
+import itertools
+from collections import deque
 from codebug_tether.font import FourByFiveFont
 
 
+# CodeBug's display
+DISPLAY_SIZE = 5
+DISPLAY_ROW_MASK = 0x1f
+
+
 class Sprite(object):
-    """A two dimensional sprite."""
+    """A two dimensional sprite.
+
+    Each row is stored as an int bitmask where pixel x is bit
+    (width - 1 - x), the same layout as CodeBug's display rows. Rows and
+    whole blocks of pixels are copied with shifts and masks.
+    """
 
     def __init__(self, width, height):
         self.width = width
@@ -11,96 +24,118 @@ class Sprite(object):
         self.clear()
 
     def clear(self):
-        # inner list is y so we can access it like: pixel_state[x][y]
-        self.pixel_state = [[0 for i in range(self.height)]
-                            for j in range(self.width)]
+        self.rows = [0] * self.height
+
+    @property
+    def row_mask(self):
+        return (1 << self.width) - 1
+
+    @property
+    def pixel_state(self):
+        """The pixels as a list-like view of columns: pixel_state[x][y].
+        Setting pixel_state[x][y] sets the pixel.
+        """
+        return PixelColumns(self)
+
+    @pixel_state.setter
+    def pixel_state(self, pixel_state):
+        # copy first, pixel_state might be a view of this sprite
+        pixel_state = [list(col) for col in pixel_state]
+        self.rows = [0] * self.height
+        for x, col in enumerate(pixel_state):
+            for y, state in enumerate(col):
+                if state & 1:
+                    self.rows[y] |= 1 << (self.width - 1 - x)
+
+    def _bit(self, x):
+        if x < 0:
+            x += self.width
+        if not 0 <= x < self.width:
+            raise IndexError('pixel x index out of range')
+        return 1 << (self.width - 1 - x)
 
     def set_pixel(self, x, y, state):
-        self.pixel_state[x][y] = state
+        if state & 1:
+            self.rows[y] |= self._bit(x)
+        else:
+            self.rows[y] &= ~self._bit(x)
 
     def get_pixel(self, x, y):
-        return self.pixel_state[x][y]
+        return 1 if self.rows[y] & self._bit(x) else 0
 
     def set_row(self, y, row):
         """Sets an entire row to be the value contained in line."""
-        for x in range(self.width):
-            state = (row >> (self.width - 1 - x)) & 1
-            self.set_pixel(x, y, state)
+        self.rows[y] = row & self.row_mask
 
     def get_row(self, y):
         """Returns an entire row as a number."""
-        row_state = 0
-        for x in range(self.width):
-            row_state |= (self.get_pixel(x, y) & 1) << (self.width - 1 - x)
-        return row_state;
+        return self.rows[y]
 
     def set_col(self, x, line):
         """Sets an entire column to be the value contained in line."""
+        bit = self._bit(x)
         for y in range(self.height):
-            state = (line >> (self.height - 1 - y)) & 1
-            self.set_pixel(x, y, state)
+            if (line >> (self.height - 1 - y)) & 1:
+                self.rows[y] |= bit
+            else:
+                self.rows[y] &= ~bit
 
     def get_col(self, x):
         """Returns an entire column as a number."""
+        bit = self._bit(x)
         col_state = 0
-        for y in range(self.height):
-            col_state |= (self.get_pixel(x, y) & 1) << (self.height - 1 - y)
+        for row in self.rows:
+            col_state = (col_state << 1) | (1 if row & bit else 0)
         return col_state
 
     def render_sprite(self, x, y, sprite_to_draw):
         """Renders the sprite given as an argument on this sprite at (x, y)."""
-        for j in range(sprite_to_draw.height):
-            for i in range(sprite_to_draw.width):
-                new_x = x + i
-                new_y = y + j
-                draw_x = 0 <= new_x < self.width
-                draw_y = 0 <= new_y < self.height
-                if draw_x and draw_y:
-                    self.set_pixel(new_x,
-                                   new_y,
-                                   sprite_to_draw.get_pixel(i, j))
+        # shift needed to move the other sprite's columns to x
+        shift = self.width - x - sprite_to_draw.width
+        area = _shift(sprite_to_draw.row_mask, shift) & self.row_mask
+        for j, row in enumerate(sprite_to_draw.rows):
+            new_y = y + j
+            if 0 <= new_y < self.height:
+                self.rows[new_y] = ((self.rows[new_y] & ~area) |
+                                    (_shift(row, shift) & area))
 
     def get_sprite(self, x, y, width, height):
         """Returns a new sprite of dimensions width x height from the
         given location (x, y) from this sprite.
         """
         new_sprite = Sprite(width, height)
+        # shift needed to move column x to the left of the new sprite
+        shift = x + width - self.width
+        mask = new_sprite.row_mask
         for j in range(height):
-            for i in range(width):
-                new_x = x + i
-                new_y = y + j
-                get_x = 0 <= new_x < self.width
-                get_y = 0 <= new_y < self.height
-                if get_x and get_y:
-                    new_sprite.set_pixel(i, j, self.get_pixel(new_x, new_y))
+            get_y = y + j
+            if 0 <= get_y < self.height:
+                new_sprite.rows[j] = _shift(self.rows[get_y], shift) & mask
         return new_sprite
 
     def clone(self):
         """Returns a clone of this Sprite."""
         return self.get_sprite(0, 0, self.width, self.height)
 
+    def _row_strings(self):
+        return ['{:0{}b}'.format(row, self.width) if self.width else ''
+                for row in self.rows]
+
     def invert_diagonal(self):
         """Inverts this sprite across the diagonal axis."""
-        new_sprite = Sprite(width=self.height, height=self.width)
-        for x in range(self.width):
-            new_sprite.set_row(x, self.get_col(x))
-        self.height = new_sprite.height
-        self.width = new_sprite.width
-        self.pixel_state = new_sprite.pixel_state
+        cols = [''.join(col) for col in zip(*self._row_strings())]
+        self.width, self.height = self.height, self.width
+        self.rows = [int(col, 2) if col else 0 for col in cols] or \
+            [0] * self.height
 
     def invert_vertical(self):
         """Inverts this sprite across the vertical axis."""
-        new_sprite = Sprite(self.width, self.height)
-        for y in range(self.height):
-            new_sprite.set_row(self.height-1-y, self.get_row(y))
-        self.pixel_state = new_sprite.pixel_state
+        self.rows.reverse()
 
     def invert_horizontal(self):
         """Inverts this sprite across the horizontal axis."""
-        new_sprite = Sprite(self.width, self.height)
-        for x in range(self.width):
-            new_sprite.set_col(self.width-1-x, self.get_col(x))
-        self.pixel_state = new_sprite.pixel_state
+        self.rows = [int(row[::-1], 2) if row else 0
+                     for row in self._row_strings()]
 
     def rotate90(self, rotation=1):
         """Rotate the sprite clockwise in 90degs steps. Specify the
@@ -121,22 +156,174 @@ class Sprite(object):
         """Draw a rectangle on this sprite. If line_weight is 0 then fill
         the rectangle.
         """
+        def span(x, width):
+            # bits for columns x to x + width - 1
+            shift = self.width - x - width
+            return _shift((1 << max(0, width)) - 1, shift) & self.row_mask
+
+        fill = span(x, width)
         if line_weight <= 0:
-            for j in range(height):
-                for i in range(width):
-                    self.set_pixel(x+i, y+j, 1)
+            sides = fill
         else:
-            # draw vertical
-            for height_pixel in range(height):
-                for line in range(line_weight):
-                    self.set_pixel(x+line, y+height_pixel, 1)
-                    self.set_pixel(x+width-1-line, y+height_pixel, 1)
+            sides = (span(x, line_weight) |
+                     span(x + width - line_weight, line_weight))
+        for j in range(max(0, y), min(self.height, y + height)):
+            top_or_bottom = (j < y + line_weight or
+                             j >= y + height - line_weight)
+            self.rows[j] |= fill if top_or_bottom else sides
+
+
+class PixelColumns():
+    """A list-like view of a Sprite's pixels by column, indexed
+    [x][y]. Writes go to the sprite's rows.
+    """
+
+    def __init__(self, sprite):
+        self.sprite = sprite
+
+    def __len__(self):
+        return self.sprite.width
+
+    def __getitem__(self, x):
+        if isinstance(x, slice):
+            return [self[i] for i in range(*x.indices(len(self)))]
+        self.sprite._bit(x)  # raises IndexError
+        return PixelColumn(self.sprite, x)
+
+    def __setitem__(self, x, col):
+        for y, state in enumerate(col):
+            self.sprite.set_pixel(x, y, state)
+
+    def __iter__(self):
+        for x in range(len(self)):
+            yield PixelColumn(self.sprite, x)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, PixelColumns)):
+            return NotImplemented
+        return [list(col) for col in self] == [list(col) for col in other]
+
+    def __repr__(self):
+        return repr([list(col) for col in self])
+
+
+class PixelColumn():
+    """A list-like view of column x of a Sprite's pixels."""
+
+    def __init__(self, sprite, x):
+        self.sprite = sprite
+        self.x = x
+
+    def __len__(self):
+        return self.sprite.height
+
+    def __getitem__(self, y):
+        if isinstance(y, slice):
+            return [self[i] for i in range(*y.indices(len(self)))]
+        return self.sprite.get_pixel(self.x, y)
+
+    def __setitem__(self, y, state):
+        self.sprite.set_pixel(self.x, y, state)
+
+    def __iter__(self):
+        for y in range(len(self)):
+            yield self.sprite.get_pixel(self.x, y)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, PixelColumn)):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def _shift(value, shift):
+    """Shifts value left by shift bits (right if shift is negative)."""
+    return value << shift if shift >= 0 else value >> -shift
+
+
+def scroll_positions(sprite, direction='L'):
+    """Returns the (x, y) positions to draw sprite at on CodeBug's 5x5
+    display to scroll it across in direction ('L', 'R', 'U', 'D').
+    """
+    direction = direction.upper()[0]  # only take the first char
+    if direction == 'L':
+        return [(5-i, 0) for i in range(sprite.width+5)]
+    elif direction == 'D':
+        return [(0, 5-i) for i in range(sprite.height+5)]
+    elif direction == 'R':
+        return [(5-i, 0) for i in reversed(range(sprite.width+5))]
+    elif direction == 'U':
+        return [(0, 5-i) for i in reversed(range(sprite.height+5))]
+    return []
 
-            # draw horizontal
-            for width_pixel in range(width):
-                for line in range(line_weight):
-                    self.set_pixel(x+width_pixel, y+line, 1)
-                    self.set_pixel(x+width_pixel, y+height-1-line, 1)
+
+class ScrollSequence(object):
+    """The frames for scrolling a sprite across CodeBug's display,
+    worked out up front. Each frame is the five display row bytes, all
+    of the frames are stored one after another in `frames`.
+
+    Use `compile_scroll` to make these, it keeps the most recent ones.
+    """
+
+    def __init__(self, sprite, direction='L'):
+        frames = bytearray()
+        for x, y in scroll_positions(sprite, direction):
+            # same as drawing sprite.get_sprite(-x, -y, 5, 5)
+            shift = DISPLAY_SIZE - x - sprite.width
+            for j in range(DISPLAY_SIZE):
+                sprite_y = j - y
+                if 0 <= sprite_y < sprite.height:
+                    frames.append(_shift(sprite.rows[sprite_y], shift) &
+                                  DISPLAY_ROW_MASK)
+                else:
+                    frames.append(0)
+        self.frames = bytes(frames)
+
+    def __len__(self):
+        return len(self.frames) // DISPLAY_SIZE
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('frame index out of range')
+        start = index * DISPLAY_SIZE
+        return self.frames[start:start+DISPLAY_SIZE]
+
+    def __iter__(self):
+        frames = memoryview(self.frames)
+        for start in range(0, len(frames), DISPLAY_SIZE):
+            yield frames[start:start+DISPLAY_SIZE]
+
+
+def compile_scroll(sprite, direction='L'):
+    """Returns a ScrollSequence for scrolling sprite in direction. The
+    most recently used sequences are cached, keyed on the sprite's
+    pixels, so scrolling the same message again costs nothing.
+    """
+    return _compile_scroll(sprite.width, sprite.height, tuple(sprite.rows),
+                           direction.upper()[0])
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_scroll(width, height, rows, direction):
+    sprite = Sprite(width, height)
+    sprite.rows = list(rows)
+    return ScrollSequence(sprite, direction)
+
+
+def scroll_frames(sprite, direction='L'):
+    """Returns the display frames for scrolling sprite in direction.
+    ScrollSequences are returned as they are, LazyStringSprites are
+    streamed and any other sprite is compiled with `compile_scroll`.
+    """
+    if isinstance(sprite, ScrollSequence):
+        return sprite
+    if isinstance(sprite, LazyStringSprite):
+        return sprite.scroll_frames()
+    return compile_scroll(sprite, direction)
 
 
 class CharSprite(Sprite):
@@ -148,9 +335,7 @@ class CharSprite(Sprite):
         self.render_char(character)
 
     def render_char(self, character):
-        for i in range(self.height):
-            self.set_row(self.height-i-1,
-                         self.font.get_char_map(character)[i])
+        self.rows = list(self.font.get_glyph(character))
 
 
 class StringSprite(Sprite):
@@ -191,19 +376,111 @@ class StringSprite(Sprite):
         self.render_str(string)
 
     def render_str(self, string):
-        for i, c in enumerate(string):
-            character = CharSprite(c, self.font)
-            # width and height with 1 pixel space
-            chr_width_sp = self.font.char_width + 1;
-            chr_height_sp = self.font.char_height + 1;
-            if self.direction == 'R':
-                self.render_sprite(i * chr_width_sp, 0, character)
-            elif self.direction == 'U':
-                self.render_sprite(0, i * chr_height_sp, character)
-            elif self.direction == 'D':
-                # put the space before each letter (-1 to y)
-                y = self.height-self.font.char_height-(i*chr_height_sp)-1
-                self.render_sprite(0, y, character)
-            elif self.direction == 'L':
-                x = self.width - chr_width_sp - (i*chr_width_sp)
-                self.render_sprite(x, 0, character)
+        # L and D are R and U with the characters the other way round
+        if self.direction in ('L', 'D'):
+            string = string[::-1]
+        if self.direction in ('R', 'L'):
+            # join the binary digits of each glyph row (with its 1 pixel
+            # space) and convert every row to an int once
+            if not string:
+                self.rows = [0] * self.height
+                return
+            glyphs = [self.font.get_glyph_bits(c) for c in string]
+            self.rows = [int(''.join(row), 2) for row in zip(*glyphs)]
+        else:
+            rows = []
+            for c in string:
+                rows.extend(self.font.get_glyph(c))
+                rows.append(0)
+            self.rows = rows
+
+
+class LazyStringSprite(object):
+    """A sprite of text which is read and rendered a few characters at a
+    time, for text which is very long or never ends. For example:
+
+        >>> def log_lines():
+        ...     with open('/var/log/syslog') as f:
+        ...         for line in f:
+        ...             yield from line.strip() + '   '
+        >>> codebug = CodeBug()
+        >>> codebug.scroll_sprite(LazyStringSprite(log_lines()))
+
+    The text is laid out left to right like StringSprite('...', 'R').
+    Characters are only read from text when a window from `get_sprite`
+    covers them and are forgotten once a window starts to their right,
+    so windows must move left to right (as scrolling does). `width` is
+    None until the end of the text has been read.
+    """
+
+    def __init__(self, text, font=FourByFiveFont()):
+        self.font = font
+        self.height = font.char_height
+        self._text = iter(text)
+        # glyphs of the characters from index _first onwards
+        self._glyphs = deque()
+        self._first = 0
+        self._length = None
+
+    @property
+    def width(self):
+        if self._length is None:
+            return None
+        return self._length * (self.font.char_width + 1)
+
+    def _load(self, index):
+        """Reads characters up to index, returns False if the text ends
+        before then.
+        """
+        while self._first + len(self._glyphs) <= index:
+            if self._length is not None:
+                return False
+            try:
+                character = next(self._text)
+            except StopIteration:
+                self._length = self._first + len(self._glyphs)
+                return False
+            self._glyphs.append(self.font.get_glyph(character))
+        return True
+
+    def get_sprite(self, x, y, width, height):
+        """Returns a new sprite of dimensions width x height from the
+        given location (x, y) from this sprite.
+        """
+        chr_width_sp = self.font.char_width + 1
+        first = max(0, x // chr_width_sp)
+        last = (x + width - 1) // chr_width_sp
+        if first < self._first:
+            raise IndexError('characters left of x have been forgotten')
+        self._load(last)
+        while self._first < first and self._glyphs:
+            self._glyphs.popleft()
+            self._first += 1
+        if last >= first:
+            glyphs = list(itertools.islice(self._glyphs, first - self._first,
+                                           last - self._first + 1))
+        else:
+            glyphs = []
+        # shift needed to move column x to the left of the new sprite
+        shift = x + width - (first + len(glyphs)) * chr_width_sp
+        new_sprite = Sprite(width, height)
+        mask = new_sprite.row_mask
+        for j in range(height):
+            get_y = y + j
+            if glyphs and 0 <= get_y < self.height:
+                row = 0
+                for glyph in glyphs:
+                    row = (row << chr_width_sp) | (glyph[get_y] << 1)
+                new_sprite.rows[j] = _shift(row, shift) & mask
+        return new_sprite
+
+    def scroll_frames(self):
+        """Yields the display frames for scrolling the text left across
+        CodeBug's display, reading the text as it goes.
+        """
+        chr_width_sp = self.font.char_width + 1
+        x = -DISPLAY_SIZE
+        while x < 0 or self._load(x // chr_width_sp):
+            yield bytes(self.get_sprite(x, 0, DISPLAY_SIZE,
+                                        DISPLAY_SIZE).rows)
+            x += 1
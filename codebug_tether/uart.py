@@ -0,0 +1,418 @@
+"""Streaming UART for CodeBug's extension port.
+
+UARTReader receives continuously in a background thread, so data can
+be read like a file without knowing how much is coming:
+
+    from codebug_tether import CodeBug
+    from codebug_tether.uart import UARTReader
+
+    codebug = CodeBug(threadsafe=True)
+    codebug.config_extension_uart()
+    with UARTReader(codebug, baud=9600) as gps:
+        while True:
+            print(gps.readline())
+
+UARTWriter sends streams of any length, blocking `write` while its
+queue is full:
+
+    with UARTWriter(codebug, baud=115200) as log:
+        for line in lines:
+            log.write(line)
+        log.flush()
+
+Both run in their own thread, so use a CodeBug made with
+`threadsafe=True` if anything else uses it at the same time.
+"""
+import time
+import asyncio
+import threading
+from .core import (BUFFER_SIZE,
+                   MAX_BUFFER_LENGTH,
+                   UART_DEFAULT_BAUD,
+                   UART_TX_BUFFER_INDEX,
+                   UART_RX_BUFFER_INDEX,
+                   UART_TX_GO_BUSY_MASK,
+                   UART_RX_GO_BUSY_MASK,
+                   CHANNEL_INDEX_UART_RX_OFFSET,
+                   CHANNEL_INDEX_UART_RX_LENGTH,
+                   CHANNEL_INDEX_UART_TX_OFFSET,
+                   CHANNEL_INDEX_UART_CONTROL,
+                   CodeBug)
+from .waiters import AsyncWaiters
+from .serial_channel_device import (get_packet,
+                                    set_bulk_packet,
+                                    or_packet,
+                                    get_buffer_packet,
+                                    set_buffer_packet)
+
+
+# UART control bits 2-4
+UART_BAUD_MASK = 0x7 << 2
+
+# the RX offset is one byte, so RX goes round the first RX_BUFFER_SIZE
+# bytes of the RX buffer. It is armed for RX_LENGTH bytes and RX_TOP_UP
+# (half the buffer) is ORed into the length whenever it drops below
+# that, which adds to it without stopping RX.
+RX_BUFFER_SIZE = MAX_BUFFER_LENGTH + 1
+RX_LENGTH = MAX_BUFFER_LENGTH
+RX_TOP_UP = RX_BUFFER_SIZE // 2
+
+# TX alternates between the two halves of the TX buffer
+TX_HALF_SIZE = min(BUFFER_SIZE // 2, MAX_BUFFER_LENGTH)
+
+
+class UARTReader():
+    """Receives from CodeBug's UART into a host-side buffer of up to
+    buffer_size bytes (the oldest bytes are dropped and counted in
+    `overruns` when it is full).
+
+    The device is polled with one GET BULK of the RX offset and length
+    channels. Received bytes are read out as they arrive and RX keeps
+    running round the RX buffer: whenever the length left drops below
+    half the buffer, half the buffer is added to it, so no bytes are
+    dropped while RX is re-armed. Polling backs off from min_interval to
+    max_interval while nothing arrives (max_interval is capped so that
+    the length can't run out between polls at the baud rate).
+
+    Use `read` and `readline`, or iterate with `async for`:
+
+        >>> async for data in UARTReader(codebug):
+        ...     log.write(data)
+
+    """
+
+    def __init__(self, codebug, baud=UART_DEFAULT_BAUD, buffer_size=4096,
+                 min_interval=0.002, max_interval=0.05):
+        self.codebug = codebug
+        self.baud = baud
+        self.buffer_size = buffer_size
+        self.min_interval = min_interval
+        # time for RX_TOP_UP bytes to arrive, 10 bits per byte
+        self.max_interval = min(max_interval, RX_TOP_UP * 10 / baud / 2)
+        self.overruns = 0
+        self.error = None
+        self._buffer = bytearray()
+        self._condition = threading.Condition()
+        self._waiters = AsyncWaiters()
+        self._read_pos = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self._closed = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Arms RX and starts the polling thread."""
+        baud_control = CodeBug._get_uart_control_baud(self.baud)
+        with self.codebug.pipeline():
+            self.codebug.and_mask(CHANNEL_INDEX_UART_CONTROL,
+                                  0xff ^ UART_BAUD_MASK)
+            self.codebug.set_bulk(CHANNEL_INDEX_UART_RX_OFFSET,
+                                  bytes((0, RX_LENGTH)))
+            self.codebug.or_mask(CHANNEL_INDEX_UART_CONTROL,
+                                 baud_control | UART_RX_GO_BUSY_MASK)
+        self._read_pos = 0
+        self._closed = False
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='UARTReader',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the polling thread and RX. Data already received can
+        still be read.
+        """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self.codebug.and_mask(CHANNEL_INDEX_UART_CONTROL,
+                              0xff ^ UART_RX_GO_BUSY_MASK)
+
+    @property
+    def in_waiting(self):
+        """The number of bytes which can be read without waiting."""
+        return len(self._buffer)
+
+    def read(self, size=1, timeout=None):
+        """Returns size bytes, or fewer if timeout seconds pass first
+        (waits forever if timeout is None) or the reader stops.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: len(self._buffer) >= size or self._closed, timeout)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            return data
+
+    def readline(self, timeout=None):
+        """Returns the bytes up to and including the next newline, or
+        what has arrived if timeout seconds pass first.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: b'\n' in self._buffer or self._closed, timeout)
+            end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+            data = bytes(self._buffer[:end])
+            del self._buffer[:end]
+            return data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Returns everything received so far once there is something."""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self._buffer:
+                    data = bytes(self._buffer)
+                    del self._buffer[:]
+                    return data
+                if self._closed:
+                    raise StopAsyncIteration
+                future = self._waiters.add(loop)
+            await future
+
+    def _run(self):
+        interval = self.min_interval
+        try:
+            while not self._stopping.wait(interval):
+                if self._poll():
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * 2, self.max_interval)
+        except Exception as error:
+            self.error = error
+        finally:
+            with self._condition:
+                self._closed = True
+            self._waiters.wake()
+
+    def _poll(self):
+        """Reads anything received and re-arms RX if it is running low,
+        all in one write. Returns True if there was data.
+        """
+        offset, length = self.codebug.get_bulk(CHANNEL_INDEX_UART_RX_OFFSET,
+                                               2)
+        packets = self._read_packets(offset)
+        reads = len(packets)
+        if length < RX_TOP_UP:
+            # OR adds RX_TOP_UP to the length as its bit is clear. GO is
+            # set again in case the length ran out.
+            packets.append((or_packet(CHANNEL_INDEX_UART_RX_LENGTH,
+                                      RX_TOP_UP), 0))
+            packets.append((or_packet(CHANNEL_INDEX_UART_CONTROL,
+                                      UART_RX_GO_BUSY_MASK), 0))
+        if not packets:
+            return False
+        responses = self.codebug.send_packets(packets)
+        data = b''.join(responses[:reads])
+        self._read_pos = offset
+        self._received(data)
+        return bool(data)
+
+    def _read_packets(self, offset):
+        """Returns the GET BUFFER packets which read from the last read
+        up to offset, in two parts if RX has gone round the buffer.
+        """
+        packets = []
+        start = self._read_pos
+        end = start + (offset - start) % RX_BUFFER_SIZE
+        while start < end:
+            length = min(end, RX_BUFFER_SIZE) - start
+            packets.append((get_buffer_packet(UART_RX_BUFFER_INDEX, length,
+                                              start), length))
+            start, end = 0, end - RX_BUFFER_SIZE
+        return packets
+
+    def _received(self, data):
+        if not data:
+            return
+        with self._condition:
+            self._buffer += data
+            overrun = len(self._buffer) - self.buffer_size
+            if overrun > 0:
+                del self._buffer[:overrun]
+                self.overruns += overrun
+            self._condition.notify_all()
+        self._waiters.wake()
+
+
+class UARTWriter():
+    """Transmits from a host-side queue of up to queue_size bytes.
+
+    The TX buffer is split in two: while one half is being transmitted
+    the next chunk is uploaded to the other, and as soon as the device
+    is idle that half is started (along with uploading the chunk after
+    it) in one write. The gap between chunks is one poll, so throughput
+    stays close to the baud rate.
+
+    `write` blocks while the queue is full and `flush` waits until
+    everything has been transmitted. The TX buffer is shared with SPI,
+    I2C and the colour tail, so don't use them while writing.
+    """
+
+    def __init__(self, codebug, baud=UART_DEFAULT_BAUD, queue_size=4096,
+                 poll_interval=0.001):
+        self.codebug = codebug
+        self.baud = baud
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.error = None
+        self._queue = bytearray()
+        # bytes written which haven't finished transmitting
+        self._unsent = 0
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self._closed = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """Sets the baud rate and starts the transmit thread."""
+        baud_control = CodeBug._get_uart_control_baud(self.baud)
+        with self.codebug.pipeline():
+            self.codebug.and_mask(CHANNEL_INDEX_UART_CONTROL,
+                                  0xff ^ UART_BAUD_MASK)
+            self.codebug.or_mask(CHANNEL_INDEX_UART_CONTROL, baud_control)
+        self._closed = False
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='UARTWriter',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Transmits everything written and stops the thread."""
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def write(self, data, timeout=None):
+        """Queues data, waiting while the queue is full. Returns the
+        number of bytes queued, which is less than len(data) if timeout
+        seconds pass first (waits forever if timeout is None).
+        """
+        data = memoryview(bytes(data))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        written = 0
+        with self._condition:
+            while written < len(data):
+                if self._closed or self._stopping:
+                    raise self.error or ValueError('UARTWriter is stopped.')
+                space = self.queue_size - len(self._queue)
+                if space > 0:
+                    chunk = data[written:written+space]
+                    self._queue += chunk
+                    self._unsent += len(chunk)
+                    written += len(chunk)
+                    self._condition.notify_all()
+                    continue
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                self._condition.wait(remaining)
+        return written
+
+    def flush(self, timeout=None):
+        """Waits until everything written has been transmitted. Returns
+        False if timeout seconds pass first.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._unsent == 0 or self._closed, timeout)
+
+    def _take(self, wait):
+        """Returns the next chunk from the queue, waiting for one if wait
+        is True. Returns None if there is nothing to send.
+        """
+        with self._condition:
+            if wait:
+                self._condition.wait_for(
+                    lambda: self._queue or self._stopping)
+            if not self._queue:
+                return None
+            chunk = bytes(self._queue[:TX_HALF_SIZE])
+            del self._queue[:TX_HALF_SIZE]
+            self._condition.notify_all()
+            return chunk
+
+    def _upload(self, packets, chunk, offset):
+        """Adds the packet which uploads chunk to the TX buffer at offset
+        to packets and returns the (offset, length) to start it with.
+        """
+        packets.append((set_buffer_packet(UART_TX_BUFFER_INDEX, chunk,
+                                          offset), 0))
+        self.codebug.buffer_writes[UART_TX_BUFFER_INDEX] += 1
+        return offset, len(chunk)
+
+    def _run(self):
+        ready = None
+        try:
+            while True:
+                packets = []
+                if ready is None:
+                    chunk = self._take(wait=True)
+                    if chunk is None:
+                        return
+                    ready = self._upload(packets, chunk, 0)
+                # set the offset and length then OR in GO so that the RX
+                # bits are left alone
+                packets.append((set_bulk_packet(CHANNEL_INDEX_UART_TX_OFFSET,
+                                                ready), 0))
+                packets.append((or_packet(CHANNEL_INDEX_UART_CONTROL,
+                                          UART_TX_GO_BUSY_MASK), 0))
+                sending, ready = ready, None
+                # the next chunk goes in the other half
+                free = TX_HALF_SIZE - sending[0]
+                chunk = self._take(wait=False)
+                if chunk is not None:
+                    ready = self._upload(packets, chunk, free)
+                self.codebug.send_packets(packets)
+                ready = self._wait_sent(sending[1], ready, free)
+                with self._condition:
+                    self._unsent -= sending[1]
+                    self._condition.notify_all()
+        except Exception as error:
+            self.error = error
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+
+    def _wait_sent(self, length, ready, free):
+        """Waits until length bytes have been transmitted, uploading the
+        next chunk to offset free with a poll if there wasn't one ready.
+        Returns what is ready to start.
+        """
+        # 10 bits per byte
+        time.sleep(length * 10 / self.baud)
+        while True:
+            packets = [(get_packet(CHANNEL_INDEX_UART_CONTROL), 1)]
+            chunk = None if ready is not None else self._take(wait=False)
+            if chunk is not None:
+                ready = self._upload(packets, chunk, free)
+            control = self.codebug.send_packets(packets)[0][0]
+            if not control & UART_TX_GO_BUSY_MASK:
+                return ready
+            time.sleep(self.poll_interval)
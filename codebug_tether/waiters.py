@@ -0,0 +1,35 @@
+"""Wakes asyncio tasks from other threads.
+
+Used by the classes which poll CodeBug from a background thread
+(`uart.UARTReader` and `inputs.InputWatcher`) to support `async for`.
+"""
+import threading
+
+
+class AsyncWaiters():
+    """Futures which asyncio tasks are waiting on. `wake` resolves them
+    all and can be called from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    def add(self, loop):
+        """Returns a future on loop which resolves at the next `wake`."""
+        future = loop.create_future()
+        with self._lock:
+            self._waiters.append((loop, future))
+        return future
+
+    def wake(self):
+        """Wakes every task waiting."""
+        with self._lock:
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_set_result, future)
+
+
+def _set_result(future):
+    if not future.done():
+        future.set_result(None)
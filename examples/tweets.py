@@ -140,7 +140,8 @@ if __name__ == "__main__":
 
     oauth_token, oauth_secret = twitter.read_token_file(twitter_creds)
 
-    codebug = CodeBug()
+    # the update timer runs on another thread
+    codebug = CodeBug(threadsafe=True)
 
     global twitterticker
     twitterticker = TwitterTicker(codebug,
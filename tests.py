@@ -6,9 +6,39 @@
 import time
 import serial
 import struct
+import io
+import itertools
+import asyncio
+import threading
 import unittest
-from codebug_tether.core import CodeBug
-from codebug_tether.sprites import (Sprite, StringSprite)
+from codebug_tether.core import (CodeBug, spi_control,
+                                 CHANNEL_INDEX_UART_CONTROL,
+                                 UART_RX_GO_BUSY_MASK)
+from codebug_tether.serial_channel_device import (AckError, and_packet,
+                                                  or_packet, get_packet,
+                                                  set_packet,
+                                                  set_bulk_packet,
+                                                  set_buffer_packet,
+                                                  split_responses)
+from codebug_tether.sprites import (Sprite, CharSprite, StringSprite,
+                                    LazyStringSprite, compile_scroll,
+                                    scroll_positions)
+from codebug_tether.emulator import (FakeSerialPort, I2CBus,
+                                     I2CRegisterDevice)
+from codebug_tether.aio import AsyncCodeBug
+from codebug_tether.i2c import (CodeBugI2CRegisterCache, reading, writing)
+from codebug_tether import benchmark
+from codebug_tether.display import Display
+from codebug_tether.font import FourByFiveFont
+from codebug_tether.colourtail import (CodeBugColourTail, RGBPixel,
+                                       colour_lut, MAX_PIXELS)
+from codebug_tether import effects
+from codebug_tether.uart import (UARTReader, UARTWriter)
+from codebug_tether.inputs import (InputWatcher, INPUT_A)
+from codebug_tether.scheduler import FrameScheduler
+from codebug_tether.instrumentation import (PacketStats, PacketTrace,
+                                            PacketDump, ReplaySerialPort,
+                                            read_dump)
 
 
 class TestCodeBug(unittest.TestCase):
@@ -210,6 +240,860 @@ class TestCodeBug(unittest.TestCase):
         self.assertEqual(self.codebug.get_row(0), 0x1B)
 
 
+class TestCodeBugEmulator(TestCodeBug):
+    """Runs the CodeBug tests against the emulator."""
+
+    def setUp(self):
+        self.port = FakeSerialPort()
+        self.codebug = CodeBug(self.port)
+
+    def test_pipeline(self):
+        with self.codebug.pipeline():
+            for i in range(5):
+                self.codebug.set_pixel(i, i, 1)
+            self.assertEqual(self.port.emulator.packets, [])
+        self.assertEqual(len(self.port.emulator.packets), 5)
+        self.assertEqual(self.codebug.get_bulk(0, 5),
+                         bytes((0x10, 0x08, 0x04, 0x02, 0x01)))
+
+    def test_pipeline_one_write(self):
+        port = benchmark.CountingSerialPort(self.port)
+        codebug = CodeBug(port)
+        with codebug.pipeline():
+            codebug.set_row(0, 1)
+            with codebug.pipeline():
+                codebug.or_mask(0, 2)
+            # nested pipelines are sent by the outermost one
+            self.assertEqual(port.writes, 0)
+            codebug.and_mask(0, 0xfe)
+        self.assertEqual((port.writes, port.packets, port.ack_waits),
+                         (1, 3, 1))
+        self.assertEqual(self.port.emulator.channels[0], 2)
+        with codebug.pipeline():
+            codebug.set_row(1, 5)
+            # reads send the queue with them so they see earlier writes
+            self.assertEqual(codebug.get_row(1), 5)
+            self.assertEqual(port.writes, 2)
+
+    def test_pipeline_ack_error(self):
+        packets = [(set_packet(0, 1), 0), (get_packet(0), 1),
+                   (set_packet(1, 2), 0)]
+        self.assertEqual(split_responses(packets, b'\xcb\xcb\x01\xcb'),
+                         [b'', b'\x01', b''])
+        with self.assertRaisesRegex(AckError, 'Packet 2 of 3'):
+            split_responses(packets, b'\xcb\x00\x01\xcb')
+        self.port.read = lambda size=1: bytes(size)
+        with self.assertRaisesRegex(AckError, 'Packet 1 of 2'):
+            with self.codebug.pipeline():
+                self.codebug.set_row(0, 1)
+                self.codebug.set_row(1, 1)
+
+    def test_batch(self):
+        with self.codebug.batch():
+            for y in range(5):
+                for x in range(5):
+                    self.codebug.set_pixel(x, y, (x + y) % 2)
+        self.assertEqual(self.port.emulator.packets,
+                         [bytes((0x60, 5, 0x0a, 0x15, 0x0a, 0x15, 0x0a))])
+
+    def test_batch_folds_writes(self):
+        with self.codebug.batch():
+            # only bits 0 and 2 are known, so an AND and an OR are left
+            self.codebug.or_mask(0, 0x01)
+            self.codebug.or_mask(0, 0x04)
+            self.codebug.and_mask(0, 0xfe)
+            self.codebug.set_row(1, 0x03)
+            self.codebug.or_mask(1, 0x10)
+            self.codebug.set_row(2, 0x05)
+        self.assertEqual(self.port.emulator.packets,
+                         [and_packet(0, 0xfe), or_packet(0, 0x04),
+                          set_bulk_packet(1, (0x13, 0x05))])
+        self.assertEqual(self.codebug.get_bulk(0, 3),
+                         bytes((0x04, 0x13, 0x05)))
+
+    def test_batch_keeps_order(self):
+        del self.port.emulator.packets[:]
+        with self.codebug.batch():
+            self.codebug.set_row(3, 1)
+            # anything which isn't batched sends the batch first
+            self.codebug.set_buffer(0, b'\x01')
+            self.codebug.set_row(3, 2)
+        self.assertEqual(self.port.emulator.packets,
+                         [set_packet(3, 1), set_buffer_packet(0, b'\x01'),
+                          set_packet(3, 2)])
+
+    def test_shadow(self):
+        codebug = CodeBug(self.port, shadow=True)
+        codebug.set_bulk(0, bytes((1, 2, 3, 4, 5)))
+        self.port.emulator.packets.clear()
+        self.assertEqual(codebug.get_row(2), 3)
+        self.assertEqual(codebug.get_col(4), 0x15)
+        self.assertEqual(self.port.emulator.packets, [])
+        # inputs always come from the device
+        self.port.emulator.set_input('A', 1)
+        self.assertEqual(codebug.get_input('A'), 1)
+        # recover after the device changes behind our back
+        self.port.emulator.channels[0] = 0x1f
+        self.assertEqual(codebug.get_row(0), 1)
+        codebug.sync()
+        self.assertEqual(codebug.get_row(0), 0x1f)
+
+    def test_shadow_write_through(self):
+        codebug = CodeBug(self.port, shadow=True)
+        codebug.set(0, 0x11)
+        codebug.or_mask(0, 0x02)
+        codebug.and_mask(0, 0xfe)
+        codebug.set_bulk(1, (1, 2))
+        # unknown channels are read from the device once
+        self.port.emulator.channels[3] = 7
+        self.assertEqual(codebug.get_row(3), 7)
+        del self.port.emulator.packets[:]
+        self.assertEqual(codebug.get_bulk(0, 4), bytes((0x12, 1, 2, 7)))
+        self.assertEqual(self.port.emulator.packets, [])
+
+        self.port.emulator.channels[0] = 0
+        codebug.invalidate()
+        self.assertEqual(codebug.get_row(0), 0)
+        # a missing ACK forgets the shadow too
+        self.port.emulator.channels[1] = 9
+        read = self.port.read
+        self.port.read = lambda size=1: bytes(len(read(size)))
+        self.assertRaises(AckError, codebug.set_row, 2, 1)
+        self.port.read = read
+        self.assertEqual(codebug.get_row(1), 9)
+
+    def test_shadow_threadsafe(self):
+        codebug = CodeBug(self.port, shadow=True, threadsafe=True)
+        codebug.set_row(0, 0)
+
+        def toggle(bit):
+            for i in range(200):
+                codebug.set_pixel(bit, 0, i % 2)
+            codebug.set_pixel(bit, 0, 1)
+
+        threads = [threading.Thread(target=toggle, args=(bit,))
+                   for bit in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.port.emulator.channels[0], 0x1f)
+        self.assertEqual(codebug.get_row(0), 0x1f)
+        with codebug.pipeline():
+            codebug.set_row(1, 0x0a)
+            codebug.or_mask(1, 0x01)
+            # reads see the queued writes without sending them
+            self.assertEqual(codebug.get_row(1), 0x0b)
+            self.assertEqual(self.port.emulator.channels[1], 0)
+        self.assertEqual(self.port.emulator.channels[1], 0x0b)
+        codebug.close()
+
+    def test_shadow_threadsafe_batches(self):
+        port = benchmark.CountingSerialPort(FakeSerialPort(latency=0.002))
+        codebug = CodeBug(port, shadow=True, threadsafe=True)
+
+        def read_inputs():
+            for i in range(20):
+                codebug.get_input('A')
+
+        threads = [threading.Thread(target=read_inputs) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the dispatcher still sends requests from many threads together
+        self.assertEqual(port.packets, 160)
+        self.assertLess(port.writes, 80)
+        codebug.close()
+
+    def test_threadsafe(self):
+        codebug = CodeBug(self.port, threadsafe=True)
+
+        def set_rows(row):
+            for i in range(100):
+                with codebug.pipeline():
+                    codebug.set_row(row, i & 0x1f)
+                    codebug.set_row(row, 0x1f)
+                self.assertEqual(codebug.get_row(row), 0x1f)
+
+        threads = [threading.Thread(target=set_rows, args=(row,))
+                   for row in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        codebug.close()
+
+    def test_threadsafe_dispatch(self):
+        port = benchmark.CountingSerialPort(FakeSerialPort(latency=0.002))
+        emulator = port.serial_port.emulator
+        codebug = CodeBug(port, threadsafe=True)
+
+        def read_row(row):
+            for i in range(20):
+                self.assertEqual(codebug.get_row(row), 0)
+
+        threads = [threading.Thread(target=read_row, args=(row,))
+                   for row in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # reads waiting together go out in one write
+        self.assertEqual(port.packets, 100)
+        self.assertLess(port.writes, 50)
+
+        with codebug.pipeline():
+            codebug.set_row(0, 1)
+            # other threads don't send this thread's pipeline
+            thread = threading.Thread(target=codebug.set_row, args=(1, 2))
+            thread.start()
+            thread.join()
+            self.assertEqual(emulator.channels[:2], bytearray((0, 2)))
+        self.assertEqual(emulator.channels[:2], bytearray((1, 2)))
+
+        # errors go to the thread which made the request
+        write = port.serial_port.write
+
+        def unplugged(data):
+            raise OSError('device unplugged')
+
+        port.serial_port.write = unplugged
+        self.assertRaises(OSError, codebug.set_row, 0, 3)
+        port.serial_port.write = write
+        codebug.set_row(0, 4)
+        self.assertEqual(codebug.get_row(0), 4)
+        codebug.close()
+
+    def test_asyncio(self):
+
+        async def main():
+            codebug = AsyncCodeBug(self.port)
+            await asyncio.gather(*(codebug.set_row(row, row)
+                                   for row in range(5)))
+            rows = await asyncio.gather(*(codebug.get_row(row)
+                                          for row in range(5)))
+            codebug.close()
+            return rows
+
+        self.assertEqual(asyncio.run(main()), [0, 1, 2, 3, 4])
+
+    def test_asyncio_peripherals(self):
+        port = FakeSerialPort()
+        for emulator in (self.port.emulator, port.emulator):
+            emulator.uart_timing = False
+            emulator.i2c = I2CBus(I2CRegisterDevice(0x1c, {0x12: 42}))
+        messages = (writing(0x1c, (0x12,)), reading(0x1c, 1))
+
+        async def main():
+            async with AsyncCodeBug(self.port) as codebug:
+                await codebug.set_buffer(1, b'abc', 2)
+                await codebug.uart_tx(b'hi')
+                await codebug.uart_rx_start(2)
+                self.port.emulator.uart.feed(b'ok')
+                self.assertTrue(await codebug.uart_rx_is_ready())
+                return (await codebug.get_buffer(1, 5),
+                        await codebug.i2c_transaction(*messages),
+                        await codebug.spi_transaction(bytes(3)))
+
+        self.assertEqual(asyncio.run(main()),
+                         (b'okabc', (42,), bytes((0xff,) * 3)))
+        self.assertEqual(self.port.emulator.uart.transmitted, b'hi')
+        # the same packets as the blocking API
+        codebug = CodeBug(port)
+        codebug.set_buffer(1, b'abc', 2)
+        codebug.uart_tx(b'hi')
+        codebug.uart_rx_start(2)
+        port.emulator.uart.feed(b'ok')
+        codebug.uart_rx_is_ready()
+        codebug.get_buffer(1, 5)
+        codebug.i2c_transaction(*messages)
+        codebug.spi_transaction(bytes(3))
+        self.assertEqual(self.port.emulator.packets, port.emulator.packets)
+
+    def test_asyncio_errors(self):
+        write = self.port.write
+
+        def unplugged(data):
+            raise OSError('device unplugged')
+
+        async def main():
+            codebug = AsyncCodeBug(self.port)
+            self.port.write = unplugged
+            with self.assertRaises(OSError):
+                await codebug.set_row(0, 1)
+            # the worker is still running
+            self.port.write = write
+            await codebug.set_row(0, 2)
+            self.assertEqual(await codebug.get_row(0), 2)
+            # nothing answers, close fails the request
+            self.port.write = len
+            request = asyncio.ensure_future(codebug.get_row(0))
+            await asyncio.sleep(0.01)
+            codebug.close()
+            with self.assertRaises(serial.SerialException):
+                await request
+
+        asyncio.run(main())
+
+    def test_asyncio_new_loop(self):
+        codebug = AsyncCodeBug(self.port)
+
+        async def set_and_get(row, value):
+            await codebug.set_row(row, value)
+            return await codebug.get_row(row)
+
+        # each asyncio.run has its own event loop
+        self.assertEqual(asyncio.run(set_and_get(0, 3)), 3)
+        self.assertEqual(asyncio.run(set_and_get(1, 4)), 4)
+        codebug.close()
+
+    def test_i2c_transaction(self):
+        self.port.emulator.i2c = I2CBus(
+            I2CRegisterDevice(0x1c, {0x12: 42, 0x13: 43}))
+        self.codebug.i2c_transaction(writing(0x1c, (0x14, 44)))
+        self.assertEqual(
+            self.codebug.i2c_transaction(writing(0x1c, (0x12,)),
+                                         reading(0x1c, 3)),
+            (42, 43, 44))
+
+    def test_spi_transfer(self):
+        transfers = []
+
+        def transfer(data, control):
+            transfers.append(data)
+            return bytes(value ^ 0xff for value in data)
+
+        self.port.emulator.spi.transfer = transfer
+        data = bytes(range(256)) * 3
+        del self.port.emulator.packets[:]
+        rx = self.codebug.spi_transfer(data)
+        self.assertEqual(rx, bytearray(value ^ 0xff for value in data))
+        self.assertEqual([len(t) for t in transfers], [255, 255, 255, 3])
+        self.assertEqual(b''.join(transfers), data)
+        # four chunks of upload, transfer and read back
+        self.assertEqual(len(self.port.emulator.packets), 12)
+
+        del transfers[:]
+        del self.port.emulator.packets[:]
+        self.assertIsNone(self.codebug.spi_transfer(iter(range(10)),
+                                                    write_only=True))
+        self.assertEqual(transfers, [bytes(range(10))])
+        self.assertEqual(len(self.port.emulator.packets), 2)
+        self.assertEqual(self.codebug.spi_transaction(bytes((1, 2))),
+                         bytes((0xfe, 0xfd)))
+
+        del transfers[:]
+        self.codebug.spi_transfer(bytes(10), chunk_size=4)
+        self.assertEqual([len(t) for t in transfers], [4, 4, 2])
+        # chunks must fit in buffer 0 and in a one byte length
+        for chunk_size in (0, -1, 256):
+            self.assertRaises(ValueError, self.codebug.spi_transfer,
+                              bytes(10), chunk_size=chunk_size)
+
+    def test_spi_write_read(self):
+        transfers = []
+
+        def transfer(data, control):
+            transfers.append((data, control))
+            return bytes(len(data))
+
+        self.port.emulator.spi.transfer = transfer
+        control = spi_control(spi_mode=3)
+        del self.port.emulator.packets[:]
+        self.codebug.spi_write(bytes(5), control=control)
+        # no GET BUFFER
+        self.assertEqual(len(self.port.emulator.packets), 2)
+        self.assertEqual(self.codebug.spi_read(3), bytearray(3))
+        self.assertEqual(transfers, [(bytes(5), control),
+                                     (bytes((0xff, 0xff, 0xff)),
+                                      spi_control())])
+
+    def test_uart_reader(self):
+        codebug = CodeBug(self.port, threadsafe=True)
+        data = bytes(range(256)) * 3
+        with UARTReader(codebug, baud=115200) as reader:
+            self.port.emulator.uart.feed(b'hello\nworld\n')
+            self.assertEqual(reader.readline(timeout=2), b'hello\n')
+            self.assertEqual(reader.readline(timeout=2), b'world\n')
+            # more than the device buffer, so RX is re-armed
+            self.port.emulator.uart.feed(data)
+            self.assertEqual(reader.read(len(data), timeout=5), data)
+
+            async def read_async():
+                self.port.emulator.uart.feed(b'abc')
+                received = b''
+                async for data in reader:
+                    received += data
+                    if len(received) == 3:
+                        return received
+
+            self.assertEqual(asyncio.run(read_async()), b'abc')
+        self.assertIsNone(reader.error)
+        self.assertEqual(reader.overruns, 0)
+        codebug.close()
+
+    def test_uart_rx_drops_when_disarmed(self):
+        emulator = self.port.emulator
+        emulator.uart_timing = False
+        # arrives before RX is armed
+        emulator.uart.feed(b'lost')
+        self.codebug.uart_rx_start(4)
+        emulator.uart.feed(b'abcdef')
+        self.assertTrue(self.codebug.uart_rx_is_ready())
+        # the two bytes after RX filled up are dropped too
+        self.assertEqual(bytes(self.codebug.uart_rx_get_buffer(4)), b'abcd')
+        self.assertEqual(emulator.uart.rx_queue, b'')
+
+    def test_uart_reader_continuous(self):
+        codebug = CodeBug(self.port, threadsafe=True)
+        data = bytes(range(256)) * 8
+        with UARTReader(codebug, baud=115200) as reader:
+            del self.port.emulator.packets[:]
+            # arrives without gaps, so bytes are lost if RX ever stops
+            self.port.emulator.uart.feed(data)
+            self.assertEqual(reader.read(len(data), timeout=5), data)
+            control = self.port.emulator.channels[CHANNEL_INDEX_UART_CONTROL]
+            self.assertTrue(control & UART_RX_GO_BUSY_MASK)
+        self.assertNotIn(and_packet(CHANNEL_INDEX_UART_CONTROL,
+                                    0xff ^ UART_RX_GO_BUSY_MASK),
+                         self.port.emulator.packets[:-1])
+        self.assertIsNone(reader.error)
+        self.assertEqual(reader.overruns, 0)
+        codebug.close()
+
+    def test_uart_writer(self):
+        codebug = CodeBug(self.port, threadsafe=True)
+        uart = self.port.emulator.uart
+        data = bytes(range(256)) * 3
+        with UARTWriter(codebug, baud=115200, queue_size=300) as writer:
+            # bigger than the queue, so it waits for room
+            self.assertEqual(writer.write(data, timeout=5), len(data))
+            self.assertTrue(writer.flush(timeout=5))
+            self.assertEqual(uart.transmitted, data)
+            writer.write(b'more')
+        self.assertEqual(uart.transmitted, data + b'more')
+        self.assertIsNone(writer.error)
+        with self.assertRaises(ValueError):
+            writer.write(b'stopped')
+        codebug.close()
+
+    def test_input_watcher(self):
+        now = [0]
+        watcher = InputWatcher(self.codebug, debounce=0.02,
+                               clock=lambda: now[0])
+        self.port.emulator.set_input(3, 1)
+        del self.port.emulator.packets[:]
+        self.assertEqual(watcher.snapshot(), 1 << 3)
+        self.assertEqual(len(self.port.emulator.packets), 1)
+
+        pressed = []
+        released = []
+        watcher.on_rising('A', pressed.append)
+        watcher.on_falling(3, released.append)
+        self.assertEqual(watcher.poll(), 0)
+        self.assertEqual(watcher.state, 1 << 3)
+        self.port.emulator.set_input('A', 1)
+        self.port.emulator.set_input(3, 0)
+        now[0] = 1
+        # not yet stable
+        self.assertEqual(watcher.poll(), 0)
+        now[0] = 1.01
+        self.port.emulator.set_input(3, 1)  # bounced
+        self.assertEqual(watcher.poll(), 0)
+        now[0] = 1.02
+        self.assertEqual(watcher.poll(), 1 << INPUT_A)
+        self.assertEqual((pressed, released), ([INPUT_A], []))
+        self.assertEqual(watcher.state, 1 << INPUT_A | 1 << 3)
+        self.port.emulator.set_input(3, 0)
+        watcher.poll()
+        now[0] = 1.05
+        self.assertEqual(watcher.poll(), 1 << 3)
+        self.assertEqual(released, [3])
+
+        async def next_events():
+            return [await watcher.__anext__() for i in range(2)]
+
+        self.assertEqual([event[:2] for event in asyncio.run(next_events())],
+                         [(INPUT_A, 1), (3, 0)])
+
+    def test_input_watcher_thread(self):
+        codebug = CodeBug(self.port, threadsafe=True)
+        pressed = threading.Event()
+        with InputWatcher(codebug, interval=0.001, debounce=0) as watcher:
+            watcher.on_rising('B', lambda index: pressed.set())
+            self.port.emulator.set_input('B', 1)
+            self.assertTrue(pressed.wait(2))
+        self.assertIsNone(watcher.error)
+        codebug.close()
+
+    def test_compile_i2c_transaction(self):
+        device = I2CRegisterDevice(0x1c, {0x12: 42, 0x13: 43})
+        self.port.emulator.i2c = I2CBus(device)
+        messages = (writing(0x1c, (0x12,)), reading(0x1c, 2))
+        controls = [message.control for message in messages]
+        read_registers = self.codebug.compile_i2c_transaction(*messages)
+        self.assertEqual([message.control for message in messages], controls)
+
+        del self.port.emulator.packets[:]
+        self.assertEqual(read_registers(), (42, 43))
+        # write, set, set and get in one write
+        self.assertEqual(len(self.port.emulator.packets), 4)
+        device.registers[0x13] = 7
+        self.assertEqual(read_registers(), (42, 7))
+
+        with self.codebug.pipeline():
+            self.codebug.set_row(0, 0x1f)
+            self.assertEqual(read_registers(), (42, 7))
+            self.assertEqual(self.port.emulator.channels[0], 0x1f)
+
+        self.assertEqual(
+            self.codebug.i2c_transaction(*messages, interval=0.001), (42, 7))
+        self.assertEqual([message.control for message in messages], controls)
+
+    def test_i2c_register_cache(self):
+        device = I2CRegisterDevice(0x1c, {0x01: 11, 0x02: 12, 0x04: 14,
+                                          0x2a: 5})
+        self.port.emulator.i2c = I2CBus(device)
+        i2c = CodeBugI2CRegisterCache(self.codebug, {0x1c: [0x2a]})
+
+        def packets_sent(function, *args):
+            del self.port.emulator.packets[:]
+            result = function(*args)
+            return result, len(self.port.emulator.packets)
+
+        read_ctrl = (writing(0x1c, (0x2a,)), reading(0x1c, 1))
+        self.assertEqual(packets_sent(i2c.transaction, *read_ctrl),
+                         ([bytes((5,))], 4))
+        self.assertEqual(packets_sent(i2c.transaction, *read_ctrl),
+                         ([bytes((5,))], 0))
+
+        # written through to the cache
+        i2c.write(0x1c, 0x2a, (9,))
+        self.assertEqual(device.registers[0x2a], 9)
+        device.registers[0x2a] = 1  # the cache doesn't see this
+        self.assertEqual(i2c.transaction(*read_ctrl), [bytes((9,))])
+
+        # two bursts (0x01-0x02 and 0x04) in one write
+        self.assertEqual(
+            packets_sent(i2c.read, 0x1c, (0x2a, 0x01, 0x02, 0x04)),
+            ((9, 11, 12, 14), 8))
+        i2c.invalidate()
+        self.assertEqual(i2c.read(0x1c, (0x2a,)), (1,))
+
+
+class TestDisplay(unittest.TestCase):
+
+    def setUp(self):
+        self.port = FakeSerialPort()
+        self.display = Display(CodeBug(self.port))
+
+    def test_flush(self):
+        self.display.set_pixel(0, 0, 1)
+        self.display.set_col(4, 0x1f)
+        self.display.flush()
+        self.assertEqual(self.port.emulator.channels[:5],
+                         bytes((0x11, 0x01, 0x01, 0x01, 0x01)))
+        self.assertEqual(len(self.port.emulator.packets), 1)
+
+        # nothing changed
+        self.display.flush()
+        self.assertEqual(len(self.port.emulator.packets), 1)
+
+        # only the changed rows are sent
+        self.port.emulator.packets.clear()
+        self.display.set_row(3, 0x1f)
+        self.display.flush()
+        self.assertEqual(self.port.emulator.packets, [bytes((0x23, 0x1f))])
+        self.port.emulator.packets.clear()
+        self.display.set_row(0, 0)
+        self.display.set_row(4, 0)
+        self.display.flush()
+        self.assertEqual(self.port.emulator.packets,
+                         [bytes((0x20, 0x00)), bytes((0x24, 0x00))])
+
+    def test_dirty_ranges(self):
+        self.display.flush()
+        self.display.set_row(0, 1)
+        self.display.set_row(3, 1)
+        # two SETs are smaller than a SET BULK of rows 0-3
+        self.assertEqual(self.display.dirty_ranges(), [(0, 1), (3, 4)])
+        self.display.set_row(1, 1)
+        self.display.set_row(4, 1)
+        # one SET BULK of 5 rows is smaller than two of 2 rows
+        self.assertEqual(self.display.dirty_ranges(), [(0, 5)])
+
+    def test_draw_sprite(self):
+        sprite = StringSprite('Hello!')
+        self.display.draw_sprite(0, 0, sprite)
+        self.display.flush()
+        self.assertEqual(self.port.emulator.channels[:5],
+                         bytes((0x12, 0x12, 0x1e, 0x12, 0x12)))
+
+
+class TestColourTail(unittest.TestCase):
+
+    def setUp(self):
+        self.port = FakeSerialPort()
+        self.codebug = CodeBug(self.port)
+        self.colourtail = CodeBugColourTail(self.codebug)
+        self.trace = PacketTrace()
+        self.codebug.add_observer(self.trace)
+
+    def buffer_writes(self):
+        """Returns (offset, length) of the SET BUFFER packets sent."""
+        writes = [(event.tx_bytes[1], event.tx_bytes[2])
+                  for event in self.trace
+                  if event.tx_bytes[0] >> 5 == 7]
+        self.trace.clear()
+        return writes
+
+    def test_update(self):
+        self.colourtail.set_pixel(0, 255, 0, 0)
+        self.colourtail.pixel_buffer[-1] = RGBPixel(0, 0, 255)
+        self.colourtail.update()
+        self.assertEqual(self.buffer_writes(), [(0, 150)])
+        pixels = self.port.emulator.colourtail.pixels
+        self.assertEqual(len(pixels), 50)
+        self.assertEqual(pixels[0], (255, 0, 0))
+        self.assertEqual(pixels[49], (0, 0, 255))
+
+        # only the changed pixels are sent
+        self.colourtail.set_pixels(3, bytes((1, 2, 3, 4, 5, 6)))
+        self.colourtail.update()
+        self.assertEqual(self.buffer_writes(), [(9, 6)])
+        self.assertEqual(self.port.emulator.colourtail.pixels[3:6],
+                         [(1, 2, 3), (4, 5, 6), (0, 0, 0)])
+        self.colourtail.update()
+        self.assertEqual(self.buffer_writes(), [])
+
+        self.colourtail.fill(0, 10, 0, 10, 20)
+        self.colourtail.update()
+        self.assertEqual(self.buffer_writes(), [(30, 30)])
+        self.assertEqual(self.colourtail.pixel_buffer[10:12],
+                         [RGBPixel(0, 10, 0)] * 2)
+
+        # something else used buffer 0, so everything is sent again
+        self.codebug.uart_tx(bytes(10))
+        self.trace.clear()
+        self.colourtail.set_pixel(0, 0, 0, 0)
+        self.colourtail.update()
+        self.assertEqual(self.buffer_writes(), [(0, 150)])
+        self.assertEqual(self.port.emulator.colourtail.pixels[12],
+                         (0, 10, 0))
+
+    def test_out_of_range(self):
+        for call in (lambda: self.colourtail.set_pixel(50, 1, 2, 3),
+                     lambda: self.colourtail.set_pixel(-51, 1, 2, 3),
+                     lambda: self.colourtail.get_pixel(50),
+                     lambda: self.colourtail.pixel_buffer[50],
+                     lambda: self.colourtail.set_pixels(49, bytes(6)),
+                     lambda: self.colourtail.fill(1, 2, 3, 45, 60),
+                     lambda: self.colourtail.fill(1, 2, 3, -1)):
+            with self.assertRaises(IndexError):
+                call()
+        self.assertEqual(len(self.colourtail.grb), 150)
+        self.colourtail.set_pixel(-50, 1, 2, 3)
+        self.assertEqual(self.colourtail.get_pixel(0), (1, 2, 3))
+
+    def test_long_strip(self):
+        colourtail = CodeBugColourTail(self.codebug, MAX_PIXELS)
+        colourtail.fill(1, 2, 3)
+        colourtail.update()
+        self.assertEqual(self.buffer_writes(), [(0, 3 * MAX_PIXELS)])
+        self.assertEqual(self.port.emulator.colourtail.pixels,
+                         [(1, 2, 3)] * MAX_PIXELS)
+
+        colourtail.set_pixel(50, 4, 5, 6)
+        colourtail.set_pixel(-1, 7, 8, 9)
+        colourtail.update()
+        self.assertEqual(self.buffer_writes(), [(150, 105)])
+        pixels = self.port.emulator.colourtail.pixels
+        self.assertEqual((pixels[50], pixels[-1], pixels[49]),
+                         ((4, 5, 6), (7, 8, 9), (1, 2, 3)))
+        # the longest strip is sent in one SET BUFFER
+        self.assertLessEqual(3 * MAX_PIXELS,
+                             len(self.port.emulator.buffers[0]))
+        self.assertRaises(ValueError, CodeBugColourTail, self.codebug,
+                          MAX_PIXELS + 1)
+
+    def test_colourtail_sweep(self):
+        counter = benchmark.CountingSerialPort(self.port)
+        results = benchmark.colourtail_sweep(CodeBug(counter), counter,
+                                             (10, 80), repeat=2)
+        self.assertEqual(results['10']['packets'], 2)
+        self.assertEqual(results['80']['packets'], 2)
+
+    def test_effects(self):
+        chase = effects.chase(50, (255, 0, 0), tail=2)
+        self.assertEqual(len(chase), 50)
+        self.assertEqual(chase[1][:9], bytes((0, 128, 0, 0, 255, 0, 0, 0, 0)))
+        fade = effects.fade(50, (0, 0, 0), (100, 50, 0), steps=3)
+        self.assertEqual([frame[:3] for frame in fade],
+                         [bytes((0, 0, 0)), bytes((25, 50, 0)),
+                          bytes((50, 100, 0))])
+        self.assertEqual(len(fade + chase), 53)
+        breathe = effects.breathe(50, (0, 0, 255), steps=2)
+        self.assertEqual([frame[2] for frame in breathe], [0, 255])
+        self.assertEqual(len(effects.rainbow(50)), 50)
+
+        corrected = fade.corrected(gamma=2, brightness=0.5)
+        lut = colour_lut(2, 0.5)
+        self.assertEqual(corrected.frames, bytes(lut[b] for b in fade.frames))
+        self.assertEqual(lut[255], 128)
+
+        scheduler = self.colourtail.play(chase, interval=0, repeat=2)
+        self.assertEqual(scheduler.frames, 100)
+        self.assertEqual(self.port.emulator.colourtail.pixels[49],
+                         (255, 0, 0))
+        self.assertRaises(ValueError, self.colourtail.play,
+                          effects.rainbow(10))
+
+    def test_correction(self):
+        self.colourtail.fill(255, 255, 255)
+        self.colourtail.set_correction(brightness=(1, 0.5, 0.25))
+        self.colourtail.update()
+        self.assertEqual(self.port.emulator.colourtail.pixels[0],
+                         (255, 128, 64))
+        self.colourtail.set_pixel(1, 128, 128, 128)
+        self.colourtail.update()
+        self.assertEqual(self.buffer_writes()[-1], (3, 3))
+        self.assertEqual(self.port.emulator.colourtail.pixels[1],
+                         (128, 64, 32))
+        # the host keeps the uncorrected colours
+        self.assertEqual(self.colourtail.get_pixel(1),
+                         RGBPixel(128, 128, 128))
+
+        # changing the correction sends everything again
+        self.colourtail.set_correction(gamma=2)
+        self.colourtail.update()
+        self.assertEqual(self.buffer_writes(), [(0, 150)])
+        self.assertEqual(self.port.emulator.colourtail.pixels[:2],
+                         [(255, 255, 255), (64, 64, 64)])
+
+        # brighter than full is clamped, lists work like tuples
+        self.assertEqual(colour_lut(brightness=2)[200], 255)
+        self.colourtail.set_correction(gamma=[1, 1, 1],
+                                       brightness=[2, 1, 0.5])
+        self.colourtail.update()
+        self.assertEqual(self.port.emulator.colourtail.pixels[1],
+                         (255, 128, 64))
+
+    def test_instances_are_separate(self):
+        other = CodeBugColourTail(self.codebug)
+        self.colourtail.set_pixel(0, 255, 255, 255)
+        self.assertEqual(other.get_pixel(0), RGBPixel(0, 0, 0))
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_observers(self):
+        codebug = CodeBug(FakeSerialPort())
+        stats = PacketStats()
+        trace = PacketTrace(maxlen=2)
+        dump_file = io.BytesIO()
+        for observer in (stats, trace, PacketDump(dump_file)):
+            codebug.add_observer(observer)
+        codebug.set_pixel(0, 0, 1)
+        codebug.set_bulk(0, bytes(5))
+        rows = codebug.get_bulk(0, 5)
+        self.assertEqual(stats.packets, 3)
+        self.assertEqual(stats.commands['OR'], 1)
+        self.assertEqual([event.length for event in trace], [5, 5])
+        self.assertEqual(trace.events[-1].rx_bytes, b'\xcb' + rows)
+
+        # replay the dump
+        dump_file.seek(0)
+        replay = CodeBug(ReplaySerialPort(read_dump(dump_file)))
+        replay.set_pixel(0, 0, 1)
+        replay.set_bulk(0, bytes(5))
+        self.assertEqual(replay.get_bulk(0, 5), rows)
+        self.assertRaises(ValueError, replay.set_row, 0, 1)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        counter = benchmark.CountingSerialPort(FakeSerialPort())
+        results = benchmark.run(CodeBug(counter), counter, repeat=2)
+        self.assertEqual(results['set_pixel']['packets'], 1)
+        self.assertEqual(results['set_col']['ack_waits'], 2)
+        changes = benchmark.compare(results, results)
+        self.assertEqual(changes['spi_transaction']['packets'], 1)
+
+
+class TestFrameScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.shown = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def render(self, cost):
+        def render(frame):
+            self.shown.append((frame, self.now))
+            self.now += cost
+        return render
+
+    def test_no_drift(self):
+        scheduler = FrameScheduler(0.1, clock=self.clock, sleep=self.sleep)
+        scheduler.play(range(10), self.render(0.03))
+        self.assertEqual([frame for frame, t in self.shown], list(range(10)))
+        for i, (frame, t) in enumerate(self.shown):
+            self.assertAlmostEqual(t, i * 0.1)
+        self.assertAlmostEqual(self.now, 1.0)
+        self.assertAlmostEqual(scheduler.fps, 10)
+        self.assertEqual((scheduler.late, scheduler.skipped), (0, 0))
+
+    def test_skip_late_frames(self):
+        scheduler = FrameScheduler(0.125, clock=self.clock, sleep=self.sleep)
+        scheduler.play(range(10), self.render(0.3))
+        self.assertEqual([frame for frame, t in self.shown], [0, 2, 4, 7, 9])
+        self.assertEqual(scheduler.skipped, 5)
+        self.assertEqual(scheduler.late, 4)
+
+        self.shown = []
+        scheduler = FrameScheduler(0.125, skip=False, clock=self.clock,
+                                   sleep=self.sleep)
+        scheduler.play(range(10), self.render(0.3))
+        self.assertEqual(len(self.shown), 10)
+        self.assertEqual(scheduler.skipped, 0)
+
+    def test_last_frame_shown(self):
+        for cost in (0.017, 0.026, 0.031, 0.043):
+            self.shown = []
+            scheduler = FrameScheduler(0.01, clock=self.clock,
+                                       sleep=self.sleep)
+            scheduler.play(range(20), self.render(cost))
+            self.assertEqual(self.shown[-1][0], 19)
+
+    def test_frames_fetched_when_due(self):
+        events = []
+
+        def source():
+            for i in range(3):
+                events.append(('fetch', i))
+                yield i
+
+        scheduler = FrameScheduler(0.1, clock=self.clock, sleep=self.sleep)
+        scheduler.play(source(), lambda frame: events.append(('draw', frame)))
+        self.assertEqual(events, [('fetch', 0), ('draw', 0),
+                                  ('fetch', 1), ('draw', 1),
+                                  ('fetch', 2), ('draw', 2)])
+
+    def test_codebug_play(self):
+        codebug = CodeBug(FakeSerialPort())
+        frames = [StringSprite('A'), bytes((1, 2, 3, 4, 5))]
+        scheduler = codebug.play(frames, interval=0)
+        self.assertEqual(scheduler.frames, 2)
+        self.assertEqual(codebug.get_bulk(0, 5), bytes((1, 2, 3, 4, 5)))
+
+
 class TestSprites(unittest.TestCase):
 
     def test_string_sprite(self):
@@ -241,6 +1125,43 @@ class TestSprites(unittest.TestCase):
         s = StringSprite("hello")
         self.assertEqual(s.pixel_state, expected)
 
+    def test_pixel_state_writes_through(self):
+        s = Sprite(3, 2)
+        s.pixel_state[1][0] = 1
+        self.assertEqual(s.get_pixel(1, 0), 1)
+        self.assertEqual(s.rows, [0b010, 0])
+        s.pixel_state[2] = [1, 1]
+        self.assertEqual(s.get_col(2), 0b11)
+        self.assertEqual(s.pixel_state, [[0, 0], [1, 0], [1, 1]])
+        s.pixel_state = s.pixel_state
+        self.assertEqual(s.rows, [0b011, 0b001])
+        with self.assertRaises(IndexError):
+            s.pixel_state[3]
+
+    def test_string_sprite_directions(self):
+        h = CharSprite('h')
+        i = CharSprite('i')
+        for direction, positions in (('R', ((0, 0, h), (5, 0, i))),
+                                     ('L', ((0, 0, i), (5, 0, h))),
+                                     ('U', ((0, 0, h), (0, 6, i))),
+                                     ('D', ((0, 0, i), (0, 6, h)))):
+            s = StringSprite('hi', direction)
+            expected = Sprite(s.width, s.height)
+            for x, y, character in positions:
+                expected.render_sprite(x, y, character)
+            self.assertEqual(s.rows, expected.rows)
+        self.assertEqual(StringSprite('').rows, [0] * 5)
+        self.assertIs(h.font.get_glyph('h'), i.font.get_glyph('h'))
+
+    def test_font_subclass_without_init(self):
+
+        class BlockFont(FourByFiveFont):
+            def __init__(self):
+                pass
+
+        self.assertEqual(StringSprite('h', font=BlockFont()).rows,
+                         StringSprite('h').rows)
+
     def test_rotate90(self):
 
         def fill_sprite(s):
@@ -296,6 +1217,51 @@ class TestSprites(unittest.TestCase):
                     [1, 1, 1, 1, 1]]
         self.assertEqual(s2.pixel_state, expected)
 
+    def test_get_render_sprite(self):
+        s = Sprite(3, 2)
+        s.set_row(0, 0b101)
+        s.set_row(1, 0b011)
+        big = Sprite(6, 3)
+        big.render_sprite(-1, 1, s)
+        big.render_sprite(4, 0, s)
+        self.assertEqual(big.rows, [0b000010, 0b010001, 0b110000])
+        window = big.get_sprite(-2, 1, 4, 3)
+        self.assertEqual(window.rows, [0b0001, 0b0011, 0b0000])
+
+    def test_compile_scroll(self):
+        sprite = StringSprite('Hi')
+        for direction in 'LRUD':
+            sequence = compile_scroll(sprite, direction)
+            positions = scroll_positions(sprite, direction)
+            self.assertEqual(len(sequence), len(positions))
+            for frame, (x, y) in zip(sequence, positions):
+                window = sprite.get_sprite(-x, -y, 5, 5)
+                self.assertEqual(bytes(frame), bytes(window.rows))
+        self.assertIs(compile_scroll(StringSprite('Hi')),
+                      compile_scroll(sprite))
+
+    def test_lazy_string_sprite(self):
+        text = 'Hello!'
+        sprite = StringSprite(text)
+        lazy = LazyStringSprite(iter(text))
+        self.assertIsNone(lazy.width)
+        for x in range(-5, sprite.width):
+            self.assertEqual(lazy.get_sprite(x, 0, 5, 5).rows,
+                             sprite.get_sprite(x, 0, 5, 5).rows)
+        self.assertEqual(lazy.width, sprite.width)
+        self.assertRaises(IndexError, lazy.get_sprite, 0, 0, 5, 5)
+
+        frames = list(LazyStringSprite(text).scroll_frames())
+        self.assertEqual(frames, [bytes(frame)
+                                  for frame in compile_scroll(sprite)])
+
+        # endless text is only read as far as it has been scrolled
+        endless = LazyStringSprite(itertools.cycle('ab'))
+        frames = endless.scroll_frames()
+        for frame in itertools.islice(frames, 1000):
+            pass
+        self.assertLessEqual(len(endless._glyphs), 2)
+
     def test_invert(self):
 
         def fill_sprite(s):